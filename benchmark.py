@@ -0,0 +1,508 @@
+"""
+Benchmarks for the Google translate plus extension.
+
+Run from the text-generation-webui directory:
+
+    python -m extensions.google_translate_plus.benchmark formatting
+    python -m extensions.google_translate_plus.benchmark translate --latency 0.08 --jitter 0.02
+    python -m extensions.google_translate_plus.benchmark translate --engine libre-http --failure-rate 0.05
+    python -m extensions.google_translate_plus.benchmark concurrent --chats 32 --stream
+    python -m extensions.google_translate_plus.benchmark memory --edits 3 --fuzzy-threshold 0.85
+    python -m extensions.google_translate_plus.benchmark startup --runs 5
+
+The translate benchmark never leaves the machine: it runs translate_text, input_modifier and
+output_modifier end to end against an in-process mock engine, or against a local HTTP stand-in
+that speaks the LibreTranslate API.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import re
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from extensions.google_translate_plus import script
+
+MARKDOWN_BLOCK = (
+    "She leaned closer. **Listen carefully**, she said, *almost whispering*. "
+    "Check the `config.yaml` file and the [manual](https://example.com/manual) first.\n"
+    "```python\n"
+    "def greet(name):\n"
+    "    return f\"Hello, {name}!\"\n"
+    "```\n"
+    "Then <b>restart</b> the service and __never__ touch ~~the old one~~ again.\n\n"
+)
+
+CHAT_TURNS = [
+    "Hi! How are you today?",
+    "*waves* Nice to see you again.",
+    "What do you want to do this evening?",
+    "I think we should take the northern road. It is safer.",
+    "Sure, tell me more about the castle.",
+    "That sounds great! Let's go.",
+    "Wait... did you hear that?",
+    "I'm not sure this is a good idea, but okay.",
+]
+
+def markdown_text(size):
+    """Markdown-heavy text of roughly size characters"""
+    return (MARKDOWN_BLOCK * (size // len(MARKDOWN_BLOCK) + 1))[:size]
+
+def build_corpus(long_size):
+    """Named message sets as (name, target language, messages)"""
+    long_replies = [markdown_text(long_size + 500 * i) for i in range(4)]
+    return [
+        ("short chat turns", "ru", CHAT_TURNS),
+        ("long markdown replies", "ru", long_replies),
+        ("short chat turns (RTL)", "ar", CHAT_TURNS),
+        ("long markdown replies (RTL)", "ar", long_replies),
+    ]
+
+class MockEngine:
+    """
+    In-process stand-in for a translation engine with configurable latency, jitter, failure rate,
+    per-request size limit and requests-per-second ceiling (above which it throttles). It returns
+    the text unchanged and counts requests and characters.
+    """
+    def __init__(self, latency=0.05, jitter=0.02, failure_rate=0.0, max_chars=5000, seed=None, max_rps=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.max_chars = max_chars
+        self.max_rps = max_rps
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.chars = 0
+        self.throttled = 0
+        self.recent = deque()
+
+    def translate(self, text, sourcelang=None, targetlang=None):
+        return self.translate_batch([text], sourcelang, targetlang)[0]
+
+    def translate_batch(self, texts, sourcelang=None, targetlang=None):
+        size = sum(len(text) for text in texts)
+        with self.lock:
+            self.requests += 1
+            self.chars += size
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            fail = self.random.random() < self.failure_rate
+            if self.max_rps:
+                # Throttle like a real engine once more than max_rps requests arrive within a second
+                now = time.monotonic()
+                while self.recent and now - self.recent[0] > 1:
+                    self.recent.popleft()
+                self.recent.append(now)
+                if len(self.recent) > self.max_rps:
+                    self.throttled += 1
+                    raise script.TranslationThrottled("HTTP 429 Too Many Requests")
+        time.sleep(delay)
+        if size > self.max_chars:
+            raise ValueError(f"request of {size} characters exceeds the limit of {self.max_chars}")
+        if fail:
+            raise RuntimeError("simulated engine failure")
+        return list(texts)
+
+    def counters(self):
+        with self.lock:
+            return self.requests, self.chars
+
+class MockLibreTranslateHandler(BaseHTTPRequestHandler):
+    """Minimal LibreTranslate API (/translate and /languages) backed by the server's MockEngine"""
+    def do_GET(self):
+        if urlparse(self.path).path.rstrip('/') == "/languages":
+            languages = [{"code": code, "name": name, "targets": []} for name, code in script.language_codes.items()]
+            self.send_json(200, languages)
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != "/translate":
+            self.send_json(404, {"error": "Not found"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode('utf-8')
+        if "json" in (self.headers.get("Content-Type") or ""):
+            payload = json.loads(body or "{}")
+        else:
+            payload = {key: values[0] for key, values in parse_qs(body).items()}
+            payload.update({key: values[0] for key, values in parse_qs(url.query).items()})
+        q = payload.get("q", "")
+        texts = q if isinstance(q, list) else [q]
+        try:
+            translated = self.server.engine.translate_batch(texts, payload.get("source"), payload.get("target"))
+        except script.TranslationThrottled as e:
+            self.send_json(429, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, {"translatedText": translated if isinstance(q, list) else translated[0]})
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_mock_libretranslate(engine, host="127.0.0.1", port=0):
+    """Serve the LibreTranslate API on a background thread; returns the server and its base URL"""
+    server = ThreadingHTTPServer((host, port), MockLibreTranslateHandler)
+    server.daemon_threads = True
+    server.engine = engine
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/"
+
+def percentile(values, percent):
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+def apply_params(updates):
+    """Update script.params and publish the new settings snapshot, as saving the settings does"""
+    script.params.update(updates)
+    script.translation_service.update_settings()
+
+def run_messages(entry_point, messages, target, iterations, engine):
+    """Translate every message iterations times and collect latency and engine counters"""
+    apply_params({'language string': target})
+    calls = {
+        "translate_text": lambda text: script.translate_text(text, "en", target),
+        "input_modifier": script.input_modifier,
+        "output_modifier": script.output_modifier,
+    }
+    translate = calls[entry_point]
+
+    latencies = []
+    chars_in = 0
+    requests_before, chars_before = engine.counters()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for message in messages:
+            begin = time.perf_counter()
+            translate(message)
+            latencies.append(time.perf_counter() - begin)
+            chars_in += len(message)
+    elapsed = time.perf_counter() - start
+    requests_after, chars_after = engine.counters()
+    return {
+        "messages": len(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "requests_per_message": (requests_after - requests_before) / len(latencies),
+        "chars_sent": chars_after - chars_before,
+        "chars_in": chars_in,
+        "messages_per_second": len(latencies) / elapsed,
+        "chars_per_second": chars_in / elapsed,
+    }
+
+@contextlib.contextmanager
+def mock_engine_settings(args, engine):
+    """Point the extension at the mock engine with caching disabled, restoring params afterwards"""
+    saved_params = dict(script.params)
+    server = None
+    try:
+        apply_params({
+            "Translate_user_input": True,
+            "Translate_system_output": True,
+            "enable_input_caching": False,
+            "enable_output_caching": False,
+            "stream_output_translation": False,
+            "enable_translation_memory": False,
+            "skip_same_language": args.skip_same_language,
+            "debug": False,
+        })
+        if args.engine == "libre-http":
+            server, url = start_mock_libretranslate(engine)
+            script.engine_info.pop('libre', None)
+            apply_params({"engine": "libre", "LibreTranslateAPI": url, "LibreTranslateAPIkey": ""})
+        else:
+            script.register_engine("mock", engine,
+                max_request={'size': args.max_chars, 'unit': 'chars'},
+                batch_limits={'texts': 50, 'size': args.max_chars, 'unit': 'chars'} if args.batch else None)
+            apply_params({"engine": "mock"})
+        apply_params({"rate_limits": {script.params["engine"]: {"requests_per_second": args.rate_limit, "chars_per_minute": 0}}})
+
+        print(f"Engine: {args.engine}, latency {args.latency * 1000:.0f}±{args.jitter * 1000:.0f} ms, "
+              f"failure rate {args.failure_rate:.0%}, request limit {args.max_chars} chars, "
+              f"throttles above {args.engine_rps or 'unlimited'} req/s, client limit {args.rate_limit or 'unlimited'} req/s")
+        yield
+    finally:
+        script.params.clear()
+        script.params.update(saved_params)
+        script.translation_service.update_settings()
+        script.unregister_engine("mock")
+        if server is not None:
+            server.shutdown()
+
+def bench_translate(args):
+    """End-to-end latency and request statistics against the mock engine"""
+    engine = MockEngine(args.latency, args.jitter, args.failure_rate, args.max_chars, args.seed, args.engine_rps)
+    with mock_engine_settings(args, engine):
+        header = f"{'entry point':<16} {'corpus':<28} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/msg':>8} {'chars sent':>11} {'msg/s':>7} {'chars/s':>9}"
+        print(header)
+        print("-" * len(header))
+        for name, target, messages in build_corpus(args.long_size):
+            for entry_point in args.entry_points:
+                stats = run_messages(entry_point, messages, target, args.iterations, engine)
+                print(f"{entry_point:<16} {name:<28} {stats['p50'] * 1000:>8.1f} {stats['p95'] * 1000:>8.1f} {stats['p99'] * 1000:>8.1f} "
+                      f"{stats['requests_per_message']:>8.2f} {stats['chars_sent']:>11} {stats['messages_per_second']:>7.1f} {stats['chars_per_second']:>9.0f}")
+        print(f"Requests throttled by the engine: {engine.throttled}")
+
+def stream_prefixes(text, words_per_chunk=4):
+    """The growing prefixes of text that the webui passes to output_modifier while streaming"""
+    ends = [match.end() for match in re.finditer(r"\S+\s*", text)][words_per_chunk - 1::words_per_chunk]
+    return [text[:end] for end in ends if end < len(text)] + [text]
+
+def run_chat(chat, args, rng):
+    """
+    One simulated chat: user turns through input_modifier and replies through output_modifier.
+    Some user turns are shared by every chat, so identical requests overlap across chats.
+
+    Returns:
+        (modifier call latencies, number of replies that came back with another chat's text)
+    """
+    state = {"unique_id": f"chat-{chat}", "character_menu": "Assistant"}
+    latencies = []
+    mixups = 0
+    for turn in range(args.turns):
+        if rng.random() < args.shared:
+            message = CHAT_TURNS[turn % len(CHAT_TURNS)]
+        else:
+            message = f"Chat {chat} says: {CHAT_TURNS[rng.randrange(len(CHAT_TURNS))]}"
+        begin = time.perf_counter()
+        script.input_modifier(message, state, is_chat=True)
+        latencies.append(time.perf_counter() - begin)
+
+        reply = f"Chat {chat} answers turn {turn}. " + " ".join(rng.sample(CHAT_TURNS, 3))
+        for prefix in (stream_prefixes(reply) if args.stream else [reply]):
+            begin = time.perf_counter()
+            translated = script.output_modifier(prefix, state, is_chat=True)
+            latencies.append(time.perf_counter() - begin)
+        if set(re.findall(r"Chat (\d+)", translated)) != {str(chat)}:
+            mixups += 1
+    return latencies, mixups
+
+def bench_concurrent(args):
+    """Many chats translating at once: latency, coalesced requests and cross-chat mix-ups"""
+    engine = MockEngine(args.latency, args.jitter, args.failure_rate, args.max_chars, args.seed, args.engine_rps)
+    with mock_engine_settings(args, engine):
+        apply_params({"stream_output_translation": args.stream, "language string": "ru"})
+        script.translation_metrics.reset()
+        rngs = [random.Random(None if args.seed is None else args.seed + chat) for chat in range(args.chats)]
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.chats) as executor:
+            results = list(executor.map(lambda chat: run_chat(chat, args, rngs[chat]), range(args.chats)))
+        elapsed = time.perf_counter() - start
+
+        latencies = [latency for chat_latencies, _ in results for latency in chat_latencies]
+        mixups = sum(chat_mixups for _, chat_mixups in results)
+        counters = script.translation_metrics.snapshot()["engines"].get(script.params["engine"], {})
+        requests, _ = engine.counters()
+        print(f"{args.chats} chats x {args.turns} turns, {args.shared:.0%} shared user turns, "
+              f"{'streamed' if args.stream else 'whole'} replies")
+        print(f"Modifier calls: {len(latencies)} in {elapsed:.2f} s ({len(latencies) / elapsed:.1f}/s)")
+        print(f"Latency p50 {percentile(latencies, 50) * 1000:.1f} ms, p95 {percentile(latencies, 95) * 1000:.1f} ms, "
+              f"p99 {percentile(latencies, 99) * 1000:.1f} ms")
+        print(f"Translations: {counters.get('messages', 0)}, coalesced: {counters.get('coalesced', 0)}, "
+              f"engine requests: {requests}, failures: {counters.get('failures', 0)}")
+        print(f"Replies with another chat's text: {mixups}")
+
+def roleplay_reply(rng, paragraphs=5):
+    """A multi-paragraph reply built from the chat turns"""
+    return "\n\n".join(" ".join(rng.sample(CHAT_TURNS, 3)) for _ in range(paragraphs))
+
+def edit_reply(reply, rng):
+    """The reply with one word of one paragraph changed, like a small manual edit"""
+    paragraphs = reply.split("\n\n")
+    idx = rng.randrange(len(paragraphs))
+    words = paragraphs[idx].split(" ")
+    words[rng.randrange(len(words))] = rng.choice(["really", "quietly", "maybe", "tonight"])
+    paragraphs[idx] = " ".join(words)
+    return "\n\n".join(paragraphs)
+
+def bench_memory(args):
+    """Characters and requests sent for a session of replies that are edited and regenerated"""
+    engine = MockEngine(args.latency, args.jitter, args.failure_rate, args.max_chars, args.seed, args.engine_rps)
+    rng = random.Random(args.seed)
+    messages = []
+    for _ in range(args.replies):
+        reply = roleplay_reply(rng)
+        messages.append(reply)
+        for _ in range(args.edits):
+            reply = edit_reply(reply, rng)
+            messages.append(reply)
+        # A regeneration keeps some paragraphs of the previous reply
+        kept = reply.split("\n\n")[:2]
+        messages.append("\n\n".join(kept + roleplay_reply(rng, 3).split("\n\n")))
+
+    modes = [("off", False, 0), ("exact", True, 0), (f"fuzzy {args.fuzzy_threshold:.2f}", True, args.fuzzy_threshold)]
+    with mock_engine_settings(args, engine):
+        print(f"{args.replies} replies, {args.edits} one-word edits and a regeneration each: {len(messages)} messages")
+        header = f"{'memory':<12} {'requests':>9} {'chars sent':>11} {'chars saved':>12} {'p50 ms':>8}"
+        print(header)
+        print("-" * len(header))
+        baseline = None
+        for name, enabled, threshold in modes:
+            script.translation_memory.clear()
+            apply_params({"enable_translation_memory": enabled, "fuzzy_match_threshold": threshold, "language string": "ru"})
+            requests_before, chars_before = engine.counters()
+            latencies = []
+            for message in messages:
+                begin = time.perf_counter()
+                script.output_modifier(message)
+                latencies.append(time.perf_counter() - begin)
+            requests_after, chars_after = engine.counters()
+            chars = chars_after - chars_before
+            baseline = chars if baseline is None else baseline
+            print(f"{name:<12} {requests_after - requests_before:>9} {chars:>11} {1 - chars / baseline if baseline else 0:>12.0%} "
+                  f"{percentile(latencies, 50) * 1000:>8.1f}")
+
+def bench_detect(args):
+    """Time language detection (skip_reason) on the benchmark corpus"""
+    samples = [(name, target, message) for name, target, messages in build_corpus(args.long_size) for message in messages]
+    samples += [("code only", "ru", "```python\nprint('hello')\n```"), ("already Russian", "ru", "Привет! Как у тебя дела сегодня? Я думаю, что всё хорошо.")]
+    print(f"{'corpus':<28} {'chars':>6} {'us':>8}  decision")
+    for name, target, message in samples:
+        elapsed = best_time(lambda: script.skip_reason(message, target, script.get_settings()), args.repeat)
+        reason = script.skip_reason(message, target, script.get_settings())
+        print(f"{name:<28} {len(message):>6} {elapsed * 1e6:>8.1f}  {reason or 'translate'}")
+
+def best_time(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_formatting(args):
+    """Time the protected span scan (formatting, special symbols and the glossary) for growing inputs"""
+    settings = script.get_settings()
+    glossary = script.CompiledSettings(dict(script.params, glossary=args.glossary))
+    print(f"{'size':>8} {'protected':>10} {'time (ms)':>10} {'us/KB':>8} {'glossary ms':>12}")
+    for size in args.sizes:
+        text = markdown_text(size)
+        elapsed = best_time(lambda: script.protected_runs(text, settings), args.repeat)
+        with_glossary = best_time(lambda: script.protected_runs(text, glossary), args.repeat)
+        protected = sum(1 for _, is_protected in script.protected_runs(text, settings) if is_protected)
+        print(f"{size:>8} {protected:>10} {elapsed * 1000:>10.2f} {elapsed * 1e6 / (size / 1024):>8.1f} {with_glossary * 1000:>12.2f}")
+
+# Run in a fresh interpreter by bench_startup: times the extension import, setup() and the first translations
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from extensions.google_translate_plus import script
+imported = time.perf_counter()
+script.setup(warmup=False)
+script.params.update({"engine": "libre", "LibreTranslateAPI": sys.argv[1], "LibreTranslateAPIkey": "", "enable_input_caching": False,
+                      "enable_output_caching": False, "enable_translation_memory": False, "skip_same_language": False, "debug": False})
+script.translation_service.update_settings()
+ready = time.perf_counter()
+if sys.argv[2] == "warm":
+    script.warmup_engine("libre").join()
+warmed = time.perf_counter()
+script.translate_text("Hello, how are you today?", "en", "ru")
+first = time.perf_counter()
+script.translate_text("Where are we going tomorrow?", "en", "ru")
+second = time.perf_counter()
+print(json.dumps({"import": imported - started, "setup": ready - imported, "warmup": warmed - ready,
+                  "first": first - warmed, "second": second - first, "deep_translator": "deep_translator" in sys.modules}))
+"""
+
+def bench_startup(args):
+    """Extension import time and first-translation latency in fresh interpreters, with and without warmup"""
+    engine = MockEngine(args.latency, 0, 0, args.max_chars, args.seed)
+    server, url = start_mock_libretranslate(engine)
+    try:
+        print(f"{'mode':<8} {'import ms':>10} {'setup ms':>9} {'warmup ms':>10} {'first ms':>9} {'second ms':>10}  deep_translator loaded")
+        for mode in ("cold", "warm"):
+            runs = []
+            for _ in range(args.runs):
+                output = subprocess.run([sys.executable, "-c", STARTUP_PROBE, url, mode], capture_output=True, text=True, check=True).stdout
+                runs.append(json.loads(output.strip().splitlines()[-1]))
+            median = lambda key: percentile([run[key] for run in runs], 50) * 1000
+            print(f"{mode:<8} {median('import'):>10.1f} {median('setup'):>9.1f} {median('warmup'):>10.1f} {median('first'):>9.1f} {median('second'):>10.1f}  "
+                  f"{'yes' if any(run['deep_translator'] for run in runs) else 'no'}")
+    finally:
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Google translate plus benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    engine_options = argparse.ArgumentParser(add_help=False)
+    engine_options.add_argument("--engine", choices=["mock", "libre-http"], default="mock",
+        help="In-process mock engine, or the mock behind a local LibreTranslate-compatible HTTP server")
+    engine_options.add_argument("--latency", type=float, default=0.05, help="Mean engine latency in seconds")
+    engine_options.add_argument("--jitter", type=float, default=0.02, help="Latency jitter in seconds")
+    engine_options.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    engine_options.add_argument("--max-chars", type=int, default=5000, help="Per-request size limit of the engine")
+    engine_options.add_argument("--engine-rps", type=float, default=0, help="Requests per second above which the engine throttles (0: never)")
+    engine_options.add_argument("--rate-limit", type=float, default=0, help="Client-side requests per second limit (0: unlimited)")
+    engine_options.add_argument("--batch", action="store_true", help="Let the in-process mock engine accept batch requests")
+    engine_options.add_argument("--skip-same-language", action="store_true",
+        help="Skip text already in the target language (the corpus is English, so input_modifier sends nothing)")
+    engine_options.add_argument("--seed", type=int, default=None)
+
+    translate = subparsers.add_parser("translate", parents=[engine_options], help="End-to-end latency against a local mock engine")
+    translate.add_argument("--iterations", type=int, default=5)
+    translate.add_argument("--long-size", type=int, default=6000, help="Approximate size of the long replies")
+    translate.add_argument("--entry-points", nargs="+", default=["translate_text", "input_modifier", "output_modifier"],
+        choices=["translate_text", "input_modifier", "output_modifier"])
+    translate.set_defaults(func=bench_translate)
+
+    concurrent_chats = subparsers.add_parser("concurrent", parents=[engine_options], help="Many simulated chats translating at the same time")
+    concurrent_chats.add_argument("--chats", type=int, default=32)
+    concurrent_chats.add_argument("--turns", type=int, default=10)
+    concurrent_chats.add_argument("--shared", type=float, default=0.3, help="Fraction of user turns that every chat sends")
+    concurrent_chats.add_argument("--stream", action="store_true", help="Stream replies through output_modifier chunk by chunk")
+    concurrent_chats.set_defaults(func=bench_concurrent)
+
+    memory = subparsers.add_parser("memory", parents=[engine_options], help="Characters sent with and without the translation memory")
+    memory.add_argument("--replies", type=int, default=20)
+    memory.add_argument("--edits", type=int, default=3, help="One-word edits of every reply")
+    memory.add_argument("--fuzzy-threshold", type=float, default=0.85)
+    memory.set_defaults(func=bench_memory)
+
+    detect = subparsers.add_parser("detect", help="Time of the local language detection that decides whether to skip translation")
+    detect.add_argument("--long-size", type=int, default=6000, help="Approximate size of the long replies")
+    detect.add_argument("--repeat", type=int, default=200)
+    detect.set_defaults(func=bench_detect)
+
+    startup = subparsers.add_parser("startup", help="Extension import time and first-translation latency in fresh interpreters")
+    startup.add_argument("--runs", type=int, default=5, help="Fresh interpreters per mode")
+    startup.add_argument("--latency", type=float, default=0.05, help="Latency of the mock LibreTranslate server in seconds")
+    startup.add_argument("--max-chars", type=int, default=5000, help="Per-request size limit of the engine")
+    startup.add_argument("--seed", type=int, default=None)
+    startup.set_defaults(func=bench_startup)
+
+    formatting = subparsers.add_parser("formatting", help="Scaling of the protected span scan")
+    formatting.add_argument("--sizes", type=int, nargs="+", default=[1024, 10 * 1024, 25 * 1024, 50 * 1024, 100 * 1024])
+    formatting.add_argument("--repeat", type=int, default=5)
+    formatting.add_argument("--glossary", nargs="+", default=["Alice", "config.yaml", "Listen carefully", "the service"],
+        help="Do-not-translate terms for the glossary column")
+    formatting.set_defaults(func=bench_formatting)
+
+    args = parser.parse_args()
+    script.setup(warmup=False)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
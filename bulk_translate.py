@@ -0,0 +1,263 @@
+"""
+Bulk translation of character cards, greetings and exported chat histories.
+
+Run from the text-generation-webui directory:
+
+    python -m extensions.google_translate_plus.bulk_translate characters/Alice.json -o characters/Alice.ru.json --target ru
+    python -m extensions.google_translate_plus.bulk_translate chat.jsonl -o chat.ru.jsonl --fields mes swipes --workers 4
+
+JSON Lines inputs are read one record per line; a JSON input is a list of records or a single
+record. The strings under the selected fields, at any depth, are translated with the extension's
+saved settings. Records are translated in chunks, and the texts of a chunk are sent together in
+as few engine requests as the engine's batch limits allow; several chunks are in flight at once.
+
+Finished records are written in input order as they complete: to the output itself for JSON Lines,
+or to a journal next to the output for JSON, which is assembled once every record is done. When a
+text cannot be translated, the run stops with a non-zero exit status before writing its record.
+Running the same command again after an interruption or a failure resumes after the last record
+written.
+
+Character card macros such as {{char}} and {{user}} and the <START> separators of example dialogues
+are never sent to the engine.
+
+Every translation is also stored in the translation cache, with its disk tier enabled, so texts
+that repeat across records, files or runs are only translated once. The web UI replaces the card
+macros before the extension sees a text, so chats do not find these entries.
+"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque
+
+from extensions.google_translate_plus import script
+
+# Character card (TavernAI V1/V2, text-generation-webui) and chat export fields worth translating
+DEFAULT_FIELDS = [
+    "description", "personality", "scenario", "first_mes", "mes_example", "alternate_greetings",
+    "creator_notes", "system_prompt", "post_history_instructions", "greeting", "context", "mes", "swipes",
+]
+
+def is_jsonl(path):
+    return path.endswith((".jsonl", ".ndjson"))
+
+def read_records(path):
+    """Yield the records of a JSON or JSON Lines file; the flag tells whether a JSON input was a list"""
+    with open(path, "r", encoding="utf-8") as file:
+        if is_jsonl(path):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line), True
+        else:
+            document = json.load(file)
+            if isinstance(document, list):
+                for record in document:
+                    yield record, True
+            else:
+                yield document, False
+
+def string_slots(node, fields, selected=False):
+    """(container, key) of every non-empty string in node that lies under one of the fields"""
+    if isinstance(node, dict):
+        items = node.items()
+    elif isinstance(node, list):
+        items = enumerate(node)
+    else:
+        return
+    for key, value in items:
+        inside = selected or (isinstance(node, dict) and ("*" in fields or key in fields))
+        if isinstance(value, str):
+            if inside and value.strip():
+                yield node, key
+        else:
+            yield from string_slots(value, fields, inside)
+
+def translate_chunk(records, fields, sourcelang, targetlang):
+    """
+    Translate the selected strings of records in place with one batched call
+
+    Returns:
+        The records, the number of texts and characters, and the number of texts that failed;
+        records are left untranslated if any text failed
+    """
+    slots = [slot for record in records for slot in string_slots(record, fields)]
+    texts = [container[key] for container, key in slots]
+    translated_texts = script.translate_many(texts, sourcelang, targetlang, use_cache=True)
+    failed = translated_texts.count(None)
+    if not failed:
+        for (container, key), translated in zip(slots, translated_texts):
+            container[key] = translated
+    return records, len(texts), sum(map(len, texts)), failed
+
+def resume_journal(path):
+    """
+    Count the complete records of a journal and cut off a record that was only partly written
+
+    Returns:
+        Number of records already written
+    """
+    if not os.path.exists(path):
+        return 0
+    count = 0
+    valid = 0
+    with open(path, "rb") as file:
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                json.loads(line)
+            except ValueError:
+                break
+            count += 1
+            valid += len(line)
+    if valid != os.path.getsize(path):
+        with open(path, "r+b") as file:
+            file.truncate(valid)
+    return count
+
+class Progress:
+    """Throughput of the run, with the engine counters of the translation metrics"""
+    def __init__(self, engine, resumed):
+        self.engine = engine
+        self.resumed = resumed
+        self.started = time.perf_counter()
+        self.records = 0
+        self.texts = 0
+        self.chars = 0
+        self.reported = self.started
+        self.counters_before = self.counters()
+
+    def counters(self):
+        return script.translation_metrics.snapshot()["engines"].get(self.engine, {})
+
+    def add(self, records, texts, chars):
+        self.records += records
+        self.texts += texts
+        self.chars += chars
+
+    def report(self, final=False):
+        self.reported = time.perf_counter()
+        elapsed = max(self.reported - self.started, 1e-9)
+        counters = self.counters()
+        delta = lambda name: counters.get(name, 0) - self.counters_before.get(name, 0)
+        print(f"[Google translate plus]: {'Done: ' if final else ''}{self.records} records, {self.texts} texts, {self.chars} chars "
+              f"in {elapsed:.1f} s ({self.records / elapsed:.1f} records/s, {self.chars / elapsed:.0f} chars/s); "
+              f"{delta('requests')} requests, {delta('chars')} chars sent, {delta('cache_hits')} cache hits, {delta('skipped')} skipped"
+              + (f"; resumed after {self.resumed} records" if self.resumed else ""), flush=True)
+
+def run_parameters(args, engine, targetlang):
+    return {
+        "input": os.path.abspath(args.input),
+        "engine": engine,
+        "source": args.source,
+        "target": targetlang,
+        "fields": sorted(args.fields),
+    }
+
+def bulk_translate(args):
+    script.setup(warmup=False)
+    engine = args.engine or script.params.get('engine', 'google')
+    if engine not in script.engine_registry:
+        sys.exit(f"Unknown engine {engine}; available: {', '.join(script.engine_registry)}")
+    targetlang = args.target or script.params.get('language string', 'ru')
+    # Overrides for this process only; the settings file is left alone
+    script.params.update({"engine": engine, "language string": targetlang, "enable_disk_cache": True})
+    script.configure_cache()
+    script.translation_service.update_settings()
+
+    journal_path = args.output if is_jsonl(args.output) else args.output + ".partial.jsonl"
+    checkpoint_path = args.output + ".checkpoint"
+    parameters = run_parameters(args, engine, targetlang)
+    if args.restart:
+        for path in (journal_path, checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r", encoding="utf-8") as file:
+            if json.load(file) != parameters:
+                sys.exit(f"{checkpoint_path} belongs to a run with other arguments; pass --restart to start over")
+    elif os.path.exists(journal_path):
+        sys.exit(f"{journal_path} already exists; pass --restart to overwrite it")
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(checkpoint_path, "w", encoding="utf-8") as file:
+        json.dump(parameters, file)
+
+    done = resume_journal(journal_path)
+    progress = Progress(engine, done)
+    records = read_records(args.input)
+    is_list = True
+    pending = deque()
+    with open(journal_path, "a", encoding="utf-8") as journal, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        def submit():
+            nonlocal is_list
+            chunk = []
+            for record, is_list in records:
+                chunk.append(record)
+                if len(chunk) == args.batch_size:
+                    break
+            if chunk:
+                pending.append(pool.submit(translate_chunk, chunk, args.fields, args.source, targetlang))
+            return bool(chunk)
+
+        try:
+            for _, is_list in itertools.islice(records, done):
+                pass  # written by an earlier run
+            while len(pending) < args.workers * 2 and submit():
+                pass
+            while pending:
+                concurrent.futures.wait([pending[0]], timeout=args.report_interval)
+                while pending and pending[0].done():
+                    translated, texts, chars, failed = pending.popleft().result()
+                    if failed:
+                        # Nothing from this chunk on is written, so the next run starts with it
+                        for future in pending:
+                            future.cancel()
+                        progress.report()
+                        sys.exit(f"{failed} texts after record {done + progress.records} could not be translated; "
+                                 "run the same command again to retry")
+                    journal.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in translated)
+                    journal.flush()
+                    progress.add(len(translated), texts, chars)
+                    submit()
+                if time.perf_counter() - progress.reported >= args.report_interval:
+                    progress.report()
+        except KeyboardInterrupt:
+            for future in pending:
+                future.cancel()
+            progress.report()
+            sys.exit("Interrupted; run the same command again to resume")
+
+    if not is_jsonl(args.output):
+        with open(journal_path, "r", encoding="utf-8") as file:
+            translated = [json.loads(line) for line in file]
+        temp_path = args.output + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(translated if is_list else translated[0], file, ensure_ascii=False, indent=4)
+        os.replace(temp_path, args.output)
+        os.remove(journal_path)
+    os.remove(checkpoint_path)
+    progress.report(final=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Translate JSON and JSON Lines files with the Google translate plus settings")
+    parser.add_argument("input", help="JSON or JSON Lines (.jsonl) file")
+    parser.add_argument("-o", "--output", required=True, help="Output file, written in the format its extension names")
+    parser.add_argument("--source", default="en", help="Source language code")
+    parser.add_argument("--target", default=None, help="Target language code (default: the extension's language)")
+    parser.add_argument("--engine", default=None, help="Engine name, e.g. google, deepl, libre or local (default: the extension's engine)")
+    parser.add_argument("--fields", nargs="+", default=DEFAULT_FIELDS, help="Keys whose strings are translated, at any depth; * for every string")
+    parser.add_argument("--workers", type=int, default=2, help="Chunks translated at the same time")
+    parser.add_argument("--batch-size", type=int, default=16, help="Records per chunk")
+    parser.add_argument("--report-interval", type=float, default=5.0, help="Seconds between progress reports")
+    parser.add_argument("--restart", action="store_true", help="Discard the progress of an earlier run")
+    args = parser.parse_args()
+    args.workers = max(1, args.workers)
+    args.batch_size = max(1, args.batch_size)
+    bulk_translate(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Offline language detection, used to skip translating text that is already in the target language.
+
+The Unicode scripts of the letters are counted first. A script that is written by a single language
+decides on its own; for shared scripts (Latin, Cyrillic, Arabic, Devanagari) the language whose most
+frequent function words and distinctive letters occur most often wins, provided it is clearly ahead
+of the runner-up. Anything less certain is reported as unknown so that the text still gets translated.
+"""
+import re
+
+# Letter ranges of the scripts that are told apart
+SCRIPTS = {
+    'Latin': 'A-Za-zÀ-ɏḀ-ỿ',
+    'Cyrillic': 'Ѐ-ӿ',
+    'Greek': 'Ͱ-Ͽ',
+    'Armenian': '԰-֏',
+    'Hebrew': '֐-׿',
+    'Arabic': '؀-ۿݐ-ݿ',
+    'Devanagari': 'ऀ-ॿ',
+    'Bengali': 'ঀ-৿',
+    'Gurmukhi': '਀-੿',
+    'Gujarati': '઀-૿',
+    'Tamil': '஀-௿',
+    'Telugu': 'ఀ-౿',
+    'Kannada': 'ಀ-೿',
+    'Malayalam': 'ഀ-ൿ',
+    'Sinhala': '඀-෿',
+    'Thai': '฀-๿',
+    'Lao': '຀-໿',
+    'Myanmar': 'က-႟',
+    'Georgian': 'Ⴀ-ჿ',
+    'Ethiopic': 'ሀ-፿',
+    'Khmer': 'ក-៿',
+    'Hangul': 'ᄀ-ᇿ㄰-㆏가-힯',
+    'Kana': '぀-ヿ',
+    'Han': '㐀-䶿一-鿿',
+}
+SCRIPT_PATTERNS = {script: re.compile(f'[{letters}]+') for script, letters in SCRIPTS.items()}
+
+# Scripts written by a single language
+SCRIPT_LANGUAGES = {
+    'Greek': 'el', 'Armenian': 'hy', 'Hebrew': 'he', 'Bengali': 'bn', 'Gurmukhi': 'pa', 'Gujarati': 'gu',
+    'Tamil': 'ta', 'Telugu': 'te', 'Kannada': 'kn', 'Malayalam': 'ml', 'Sinhala': 'si', 'Thai': 'th',
+    'Lao': 'lo', 'Myanmar': 'my', 'Georgian': 'ka', 'Ethiopic': 'am', 'Khmer': 'km', 'Hangul': 'ko',
+}
+
+# Function words and distinctive letters of languages that share a script
+PROFILES = {
+    'Latin': {
+        'en': ("the and is are was to of in that it you for on with this have not be but what i my your how do", ""),
+        'es': ("el la los las de que y en un una es por con para no se lo del al como pero su muy", "ñ¿¡"),
+        'fr': ("le la les de des et est un une que qui en du pour pas je tu nous vous il elle dans ce sur mais avec au", "çèêœ"),
+        'de': ("der die das und ist ich nicht ein eine zu den von mit sie es du auf auch sich wir", "ßäöü"),
+        'it': ("il la di che e è un una per non in sono mi ho lo gli della le con ma questo come anche ti sei", "ì"),
+        'pt': ("o a os as de que e é um uma não em do da para com por se você mas muito", "ãõ"),
+        'nl': ("de het een en is van dat ik niet je op te zijn met voor er maar wat", "ĳ"),
+        'pl': ("i w nie się na jest to że z do co jak ale o mi tak jestem", "łąęśźżć"),
+        'tr': ("ve bir bu da de ne için çok ben sen o mi ile gibi var değil", "ğış"),
+        'sv': ("och är att det en jag som på inte med för har av till den vi", "å"),
+        'id': ("yang dan di ini itu dengan untuk tidak ada dari saya akan ke kamu", ""),
+        'vi': ("và là của không có được một những người này tôi bạn", "ăđơư"),
+        'ro': ("și este în de la un o nu că cu pe să se", "șțăâ"),
+        'cs': ("a je to že se na v není jsem s do jak ale", "řůě"),
+        'hu': ("a az és hogy nem van egy is de meg ez", "őű"),
+    },
+    'Cyrillic': {
+        'ru': ("и в не на что я с он как это по но все она так его мне ты вы у тебя меня да нет", "ыэё"),
+        'uk': ("і в не на що я з він як це та але все вона так його мені ти ви", "іїєґ"),
+        'bg': ("и в не на че за се да е от са това но ще съм", ""),
+        'sr': ("и у не на да је се за су од али то", "ђјљњћџ"),
+        'be': ("і ў не на што я з ён як гэта але", "ў"),
+        'kk': ("және мен бұл бір үшін деп ол", "әғқңөұһ"),
+    },
+    'Arabic': {
+        'ar': ("في من على أن هذا إلى ما لا هو كان", "ةى"),
+        'fa': ("و در به از که این را است با برای", "پچژگ"),
+        'ur': ("کے میں ہے کی اور سے کا نہیں یہ", "ٹڈڑںےھ"),
+    },
+    'Devanagari': {
+        'hi': ("है और के की में से का नहीं यह हैं", ""),
+        'mr': ("आहे आणि च्या ला हे नाही", "ळ"),
+        'ne': ("छ र को मा हो पनि गर्न", ""),
+    },
+}
+PROFILE_WORDS = {}  # script -> word -> languages that use it
+for script, languages in PROFILES.items():
+    index = PROFILE_WORDS[script] = {}
+    for language, (words, _) in languages.items():
+        for word in words.split():
+            index[word] = index.get(word, ()) + (language,)
+PROFILE_LETTERS = {script: {language: letters for language, (_, letters) in languages.items() if letters}
+                   for script, languages in PROFILES.items()}
+
+# Language codes used by the engines that name the same language
+LANGUAGE_ALIASES = {'iw': 'he', 'jw': 'jv', 'zh-CN': 'zh', 'zh-TW': 'zh'}
+
+LETTERS = re.compile(r'[^\W\d_]+')
+# Words, including the combining marks (vowel signs, harakat) that \w leaves out
+WORDS = re.compile(r'[\w\u0300-\u036F\u0610-\u061A\u064B-\u065F\u0900-\u0DFF]+')
+MAX_WORDS = 200
+SAMPLE_SIZE = 500  # characters taken from each end of long texts
+MIN_SCRIPT_SHARE = 0.8
+MIN_WORD_HITS = 2
+MIN_MARGIN = 2.0
+
+def base_language(code):
+    """The language part of an engine language code, e.g. zh for zh-CN and he for iw"""
+    code = LANGUAGE_ALIASES.get(code, code)
+    return code.split('-')[0].lower()
+
+def has_letters(text):
+    """Whether text contains any letters, i.e. anything worth translating"""
+    return LETTERS.search(text) is not None
+
+def detect_language(text):
+    """
+    Detect the language of text
+
+    Returns:
+        Language code, or None if the language cannot be told with confidence
+    """
+    if len(text) > 2 * SAMPLE_SIZE:
+        text = text[:SAMPLE_SIZE] + " " + text[-SAMPLE_SIZE:]
+    first = LETTERS.search(text)
+    if first is None:
+        return None
+    letters = sum(map(len, LETTERS.findall(text)))
+
+    # Count the script of the first letter first: it usually dominates and ends the scan
+    scripts = sorted(SCRIPT_PATTERNS, key=lambda script: not SCRIPT_PATTERNS[script].match(first.group(), 0, 1))
+    counts = {}
+    for script in scripts:
+        count = sum(map(len, SCRIPT_PATTERNS[script].findall(text)))
+        if count:
+            counts[script] = count
+            if count >= letters * MIN_SCRIPT_SHARE:
+                break  # no other script can dominate
+    total = max(letters, sum(counts.values()))
+
+    if counts.get('Kana') and counts.get('Kana', 0) + counts.get('Han', 0) >= total * MIN_SCRIPT_SHARE:
+        return 'ja'
+    script, count = max(counts.items(), key=lambda item: item[1], default=(None, 0))
+    if count < total * MIN_SCRIPT_SHARE:
+        return None  # mixed scripts
+    if script == 'Han':
+        return 'zh'
+    if script in SCRIPT_LANGUAGES:
+        return SCRIPT_LANGUAGES[script]
+    if script in PROFILE_WORDS:
+        return detect_by_profile(text, script)
+    return None
+
+def detect_by_profile(text, script):
+    """Pick the language of a shared script by its function words and distinctive letters"""
+    lowered = text.lower()
+    index = PROFILE_WORDS[script]
+    scores = {}
+    for word in WORDS.findall(lowered)[:MAX_WORDS]:
+        for language in index.get(word, ()):
+            scores[language] = scores.get(language, 0) + 1
+    for language, letters in PROFILE_LETTERS[script].items():
+        occurrences = sum(lowered.count(letter) for letter in letters)
+        if occurrences:
+            scores[language] = scores.get(language, 0) + occurrences // 2 + 1
+
+    ranked = sorted(scores.values(), reverse=True)
+    if not ranked or ranked[0] < MIN_WORD_HITS:
+        return None
+    if len(ranked) > 1 and ranked[0] < ranked[1] * MIN_MARGIN:
+        return None
+    return max(scores, key=scores.get)
@@ -1,513 +1,2908 @@
-import html
-import gradio as gr
-from deep_translator import GoogleTranslator, DeeplTranslator, LibreTranslator
-from extensions.google_translate_plus.lang_codes import language_codes
-import json
-import os
-import re
-import concurrent.futures
-import uuid
-
-settings_path = "extensions/google_translate_plus/settings.json"
-
-default_params = {
-    "Translate_user_input": True,
-    "Translate_system_output": True,
-    "language string": "ru",
-    "debug": False,
-    "special_symbol": "~",
-    "newline_symbol": "@",
-    "engine": "google",
-    "LibreTranslateAPI": "http://localhost:5000/",
-    "LibreTranslateAPIkey": "",
-    "DeeplAPIkey": "",
-    "DeeplFreeAPI": True,
-    "max_length": 1500,
-    "disable_split": False,
-    "disable_newline_replacement": False,
-    "enable_input_caching": True,
-    "enable_output_caching": True,
-    "translation_timeout": 10,
-    "preserve_formatting": True,
-    "rtl_support": True
-}
-
-try:
-    if os.path.exists(settings_path):
-        with open(settings_path, "r") as file:
-            params = json.load(file)
-        for key in default_params:
-            if key not in params:
-                params[key] = default_params[key]
-    else:
-        params = default_params.copy()
-        with open(settings_path, "w") as file:
-            json.dump(params, file, ensure_ascii=False, indent=4)
-except json.JSONDecodeError:
-    print("[Google translate plus]: Warning: settings.json has an invalid structure. Using default settings.")
-    params = default_params.copy()
-
-engines = {'Deepl Translator': 'deepl', 'Google Translate': 'google', 'LibreTranslate (local)': 'libre'}
-
-def input_modifier(string):
-    if not params.get('Translate_user_input', True):
-        if params.get('debug', False):
-            print("[Google translate plus]: Input text translation disabled")
-        return string
-
-    if params.get('enable_input_caching', True):
-        if hasattr(input_modifier, 'previous_text') and hasattr(input_modifier, 'previous_translation'):
-            if string == input_modifier.previous_text:
-                if params.get('debug', False):
-                    print("[Google translate plus]: Using cached translation")
-                return input_modifier.previous_translation
-
-    translated_text = translate_text(string, params.get('language string', 'ru'), "en")
-
-    if params.get('enable_input_caching', True):
-        input_modifier.previous_text = string
-        input_modifier.previous_translation = translated_text
-
-    return translated_text
-
-def output_modifier(string):
-    if not params.get('Translate_system_output', True):
-        if params.get('debug', False):
-            print("[Google translate plus]: Output text translation disabled")
-        return string
-
-    # Add caching for output text similar to input caching
-    if params.get('enable_output_caching', True):
-        if hasattr(output_modifier, 'previous_text') and hasattr(output_modifier, 'previous_translation'):
-            if string == output_modifier.previous_text:
-                if params.get('debug', False):
-                    print("[Google translate plus]: Using cached output translation")
-                return output_modifier.previous_translation
-
-    translated_text = translate_text(string, "en", params.get('language string', 'ru'))
-    
-    # Store in cache
-    if params.get('enable_output_caching', True):
-        output_modifier.previous_text = string
-        output_modifier.previous_translation = translated_text
-        
-    return translated_text
-
-def translate_text(string, sourcelang, targetlang):
-    """
-    Main translation function that handles the translation process
-    
-    Args:
-        string: The text to translate
-        sourcelang: Source language code
-        targetlang: Target language code
-        
-    Returns:
-        Translated text or original text if translation fails
-    """
-    debug = params.get('debug', False)
-    engine = params.get('engine', 'google')
-    if debug:
-        print("\n------[Google translate plus debug info]-----")
-        print(f"[Google translate plus]: Using {engine.capitalize()} Translator...")
-
-    MAX_LEN = params.get('max_length', 1500)
-    special_symbol = params.get('special_symbol', '~')
-    newline_symbol = params.get('newline_symbol', '@')
-    disable_split = params.get('disable_split', False)
-    disable_newline_replacement = params.get('disable_newline_replacement', False)
-    preserve_formatting = params.get('preserve_formatting', True)
-    rtl_support = params.get('rtl_support', True)
-    LibreTranslateAPI = params.get('LibreTranslateAPI', "http://localhost:5000/")
-    LibreTranslateAPIkey = params.get('LibreTranslateAPIkey', "")
-    DeeplAPIkey = params.get('DeeplAPIkey', "")
-    DeeplFreeAPI = params.get('DeeplFreeAPI', True)
-    translation_timeout = params.get('translation_timeout', 10)
-    
-    # Check if the target language is RTL
-    rtl_languages = ['ar', 'he', 'fa', 'ur', 'yi', 'ckb', 'sd', 'ug', 'ps']
-    is_rtl = targetlang in rtl_languages
-    
-    # Check if the language is supported by the selected engine
-    if engine == 'google' and targetlang not in GoogleTranslator().get_supported_languages():
-        if debug:
-            print(f"[Google translate plus]: Warning - Language {targetlang} may not be supported by Google Translator")
-    
-    if debug:
-        print("[Google translate plus]: Translation parameters:")
-        print(f"  Special symbol: {special_symbol}")
-        print(f"  Newline symbol: {newline_symbol}")
-        print(f"  Disable split: {disable_split}")
-        print(f"  Disable newline replacement: {disable_newline_replacement}")
-        print(f"  Preserve formatting: {preserve_formatting}")
-        print(f"  RTL support: {rtl_support} (Target language is{' ' if is_rtl else ' not '}RTL)\n")
-        print("[Google translate plus]: The text is currently being translated:")
-        print("\033[32m" + string + "\033[0m\n")
-
-    # Validate special_symbol and newline_symbol
-    if not special_symbol:
-        if debug:
-            print("[Google translate plus]: Error: Special symbol cannot be empty.")
-        return string
-    if not newline_symbol:
-        if debug:
-            print("[Google translate plus]: Error: Newline symbol cannot be empty.")
-        return string
-        
-    # Preserve formatting if enabled
-    if preserve_formatting:
-        string, format_placeholders = preserve_text_formatting(string, special_symbol)
-        
-    # Escape special_symbol in the text to avoid conflicts with the splitting pattern
-    escaped_special_symbol = special_symbol + special_symbol  # Double the symbol as an escape sequence
-    string = string.replace(special_symbol, escaped_special_symbol)
-    
-    # Now split the text using the special symbol
-    fragments = re.split(f"{re.escape(special_symbol)}(.*?){re.escape(special_symbol)}", string)
-
-    translated_fragments = []
-    try:
-        for idx, fragment in enumerate(fragments):
-            if idx % 2 == 1:
-                # Text between special symbols is not translated
-                translated_fragments.append(fragment)
-                continue
-                
-            # Restore any escaped special symbols
-            fragment = fragment.replace(escaped_special_symbol, special_symbol)
-
-            if not disable_newline_replacement:
-                # Preserve newlines with a marker to ensure they're properly restored
-                fragment = fragment.replace("\n", f" {newline_symbol} ")
-
-            if disable_split or len(fragment) <= MAX_LEN:
-                translated_str = translate_with_timeout(fragment, sourcelang, targetlang, engine, LibreTranslateAPI, LibreTranslateAPIkey, DeeplAPIkey, DeeplFreeAPI, translation_timeout)
-                if translated_str is None:
-                    if debug:
-                        print("[Google translate plus]: Translation failed, returning original text")
-                    gr.warning("Translation failed, returning original text")
-                    return string  # Return original text if translation failed
-                translated_fragments.append(translated_str)
-            else:
-                # Improved text splitting for long content
-                parts = smart_split_text(fragment, MAX_LEN, newline_symbol)
-                
-                translated_parts = []
-                for part in parts:
-                    translated_part = translate_with_timeout(part, sourcelang, targetlang, engine, LibreTranslateAPI, LibreTranslateAPIkey, DeeplAPIkey, DeeplFreeAPI, translation_timeout)
-                    if translated_part is None:
-                        if debug:
-                            print("[Google translate plus]: Translation failed, returning original text")
-                        gr.warning("Translation failed, returning original text")
-                        return string  # Return original text if translation failed
-                    translated_parts.append(translated_part)
-                
-                translated_fragments.append(" ".join(translated_parts))
-
-    except Exception as e:
-        if debug:
-            print(f"[Google translate plus]: An error occurred during translation: {e}")
-        gr.warning(f"An error occurred during translation: {e}")
-        return string
-
-    translated_text = "".join(translated_fragments)
-
-    if not disable_newline_replacement:
-        # Improved newline restoration that preserves spacing
-        regex_pattern = r'\s*{}\s*'.format(re.escape(newline_symbol))
-        translated_text = re.sub(regex_pattern, '\n', translated_text)
-    
-    # Enhanced HTML entity handling
-    translated_text = html.unescape(translated_text)
-    
-    # Restore formatting if it was preserved
-    if preserve_formatting and 'format_placeholders' in locals():
-        translated_text = restore_text_formatting(translated_text, format_placeholders)
-        
-    # Add RTL markers if needed and enabled
-    if rtl_support and is_rtl:
-        # Add RTL embedding controls for proper display
-        translated_text = f"\u202B{translated_text}\u202C"
-
-    if debug:
-        print("[Google translate plus]: The text has been successfully translated. Result:")
-        print("\033[32m" + translated_text + "\033[0m\n")
-        print("---------------------------------------------")
-    return translated_text
-
-def smart_split_text(text, max_length, newline_symbol):
-    """Split text intelligently at sentence or paragraph boundaries"""
-    if len(text) <= max_length:
-        return [text]
-        
-    parts = []
-    while len(text) > 0:
-        if len(text) <= max_length:
-            parts.append(text)
-            break
-            
-        # Try to split at paragraph (newline symbol)
-        pos = text.rfind(newline_symbol, 0, max_length)
-        
-        if pos == -1 or pos == 0:
-            # Try to split at sentence boundary
-            sentence_boundaries = ['. ', '! ', '? ', '.\n', '!\n', '?\n']
-            pos = -1
-            for boundary in sentence_boundaries:
-                boundary_pos = text.rfind(boundary, 0, max_length - len(boundary) + 2)
-                if boundary_pos > pos:
-                    pos = boundary_pos + len(boundary) - 1
-                    
-            # If no sentence boundary found, try to split at space
-            if pos == -1 or pos == 0:
-                pos = text.rfind(' ', 0, max_length)
-                
-            # If still no good split point, just split at max_length
-            if pos == -1 or pos == 0:
-                pos = max_length
-                
-        part = text[:pos+1].strip()
-        text = text[pos+1:].strip()
-        
-        if part:
-            parts.append(part)
-            
-    return parts
-
-def translate_with_timeout(fragment, sourcelang, targetlang, engine, LibreTranslateAPI, LibreTranslateAPIkey, DeeplAPIkey, DeeplFreeAPI, timeout):
-    debug = params.get('debug', False)
-    attempt = 0
-    max_attempts = 3
-    while attempt < max_attempts:
-        attempt += 1
-        try:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(perform_translation, fragment, sourcelang, targetlang, engine, LibreTranslateAPI, LibreTranslateAPIkey, DeeplAPIkey, DeeplFreeAPI)
-                translated_str = future.result(timeout=timeout)
-                if translated_str is None:
-                    if attempt < max_attempts:
-                        if debug:
-                            print(f"[Google translate plus]: Translation attempt {attempt} failed. Retrying...")
-                        continue
-                    else:
-                        if debug:
-                            print("[Google translate plus]: All translation attempts failed.")
-                        return None
-                return translated_str
-        except concurrent.futures.TimeoutError:
-            if attempt < max_attempts:
-                if debug:
-                    print(f"[Google translate plus]: Translation timed out (attempt {attempt}). Retrying...")
-                gr.warning(f"Translation timed out (attempt {attempt}). Retrying...")
-            else:
-                if debug:
-                    print("[Google translate plus]: Translation timed out after all attempts. Returning original text.")
-                gr.error("Translation timed out after all attempts. Returning original text.")
-                return None
-        except Exception as e:
-            if debug:
-                print(f"[Google translate plus]: An error occurred during translation (attempt {attempt}): {e}")
-            if attempt < max_attempts:
-                gr.warning(f"Translation error (attempt {attempt}): {e}. Retrying...")
-            else:
-                gr.error(f"Translation failed after all attempts: {e}")
-                return None
-
-def perform_translation(fragment, sourcelang, targetlang, engine, LibreTranslateAPI, LibreTranslateAPIkey, DeeplAPIkey, DeeplFreeAPI):
-    """
-    Perform the actual translation using the selected engine
-    
-    Args:
-        fragment: Text fragment to translate
-        sourcelang: Source language code
-        targetlang: Target language code
-        engine: Translation engine to use
-        LibreTranslateAPI: API URL for LibreTranslate
-        LibreTranslateAPIkey: API key for LibreTranslate
-        DeeplAPIkey: API key for DeepL
-        DeeplFreeAPI: Whether to use DeepL free API
-        
-    Returns:
-        Translated text or None if translation fails
-    """
-    fragment_unescaped = html.unescape(fragment)
-    
-    try:
-        if engine == 'google':
-            translated_str = str(GoogleTranslator(source=sourcelang, target=targetlang).translate(fragment_unescaped))
-        elif engine == 'libre':
-            translated_str = str(LibreTranslator(
-                source=sourcelang,
-                target=targetlang,
-                base_url=LibreTranslateAPI,
-                api_key=LibreTranslateAPIkey
-            ).translate(fragment_unescaped))
-        elif engine == 'deepl':
-            translated_str = str(DeeplTranslator(
-                source=sourcelang,
-                target=targetlang,
-                api_key=DeeplAPIkey,
-                use_free_api=DeeplFreeAPI
-            ).translate(fragment_unescaped))
-        else:
-            translated_str = fragment  # No translation
-            
-        return translated_str
-    except Exception as e:
-        print(f"[Google translate plus]: Translation error: {e}")
-        return None
-
-def bot_prefix_modifier(string):
-    return string
-
-def save_params():
-    with open(settings_path, "w") as file:
-        json.dump(params, file, ensure_ascii=False, indent=4)
-
-def ui():
-    # Finding the language name from the language code to use as the default value
-    language_name = next((k for k, v in language_codes.items() if v == params.get('language string', 'ru')), 'English')
-    engine_name = next((k for k, v in engines.items() if v == params.get('engine', 'google')), 'Google Translate')
-
-    # Gradio elements
-    with gr.Accordion("Google Translate Plus", open=False):
-        with gr.Column():
-            Translate_user_input = gr.Checkbox(value=params.get('Translate_user_input', True), label='Translate user input')
-            Translate_system_output = gr.Checkbox(value=params.get('Translate_system_output', True), label='Translate system output')
-            enable_input_caching = gr.Checkbox(value=params.get('enable_input_caching', True), label='Enable input caching',
-                info='If enabled, identical input texts will use the cached translation instead of re-translating.')
-            enable_output_caching = gr.Checkbox(value=params.get('enable_output_caching', True), label='Enable output caching',
-                info='If enabled, identical output texts will use the cached translation instead of re-translating.')
-            disable_split = gr.Checkbox(value=params.get('disable_split', False), label='Disable split',
-                info='Disables splitting long text into paragraphs. May improve translation quality, but Google Translate may give an error due to too long text. This will also disable the special symbol.')
-            disable_newline_replacement = gr.Checkbox(value=params.get('disable_newline_replacement', False), label='Disable newline replacement',
-                info='Disables the replacement of a newline by a special character. Recommended when using LibreTranslate.')
-            preserve_formatting = gr.Checkbox(value=params.get('preserve_formatting', True), label='Preserve formatting',
-                info='Attempts to preserve text formatting like bold, italic, and links during translation.')
-            rtl_support = gr.Checkbox(value=params.get('rtl_support', True), label='RTL language support',
-                info='Adds special markers for right-to-left languages like Arabic, Hebrew, Persian, etc.')
-            with gr.Accordion("Advanced", open=False):
-                language = gr.Dropdown(value=language_name, choices=[k for k in language_codes], label='Language')
-                engine = gr.Dropdown(value=engine_name, choices=[k for k in engines], label='Translation service')
-                special_symbol = gr.Textbox(value=params.get('special_symbol', '~'), label='Special symbol.',
-                    info='Text between two such syblols will not be translated. May cause inaccurate translations, and some symbols other than the standard ~ may cause errors.', type='text',
-                    )
-                newline_symbol = gr.Textbox(value=params.get('newline_symbol', '@'), label='Newline symbol',
-                    info='Before translation, this symbol replaces the new line, and after translation it is removed. Needed to save strings after translation. Some symbols may cause errors.',
-                    type='text',)
-                max_length = gr.Number(value=params.get('max_length', 1500), label='Maximum text length',
-                    info='If the text length exceeds this value, it will be divided into paragraphs before translation, each of which will be translated separately.',
-                    precision=0)
-                translation_timeout = gr.Number(value=params.get('translation_timeout', 10), label='Translation timeout (seconds)',
-                    info='Maximum time to wait for translation before retrying or failing.',
-                    precision=0)
-                debug = gr.Checkbox(value=params.get('debug', False), label='Log translation debug info to console')
-            with gr.Accordion("Translator settings", open=False):
-                LibreTranslateAPI = gr.Textbox(value=params.get('LibreTranslateAPI', "http://localhost:5000/"), label='LibreTranslate API',
-                    info='Your LibreTranslate address and port.',
-                    type='text',)
-                LibreTranslateAPIkey = gr.Textbox(value=params.get('LibreTranslateAPIkey', ""), label='LibreTranslate API key',
-                    info='Your LibreTranslate API key',
-                    type='text',)
-                DeeplAPIkey = gr.Textbox(value=params.get('DeeplAPIkey', ""), label='Deepl API key',
-                    info='Your Deepl Translator API key',
-                    type='text',)
-                DeeplFreeAPI = gr.Checkbox(value=params.get('DeeplFreeAPI', True), label='Use the free Deepl API')
-
-    # Event functions to update the parameters in the backend
-    Translate_user_input.change(lambda x: params.update({"Translate_user_input": x}) or save_params(), Translate_user_input, None)
-    Translate_system_output.change(lambda x: params.update({"Translate_system_output": x}) or save_params(), Translate_system_output, None)
-    enable_input_caching.change(lambda x: params.update({"enable_input_caching": x}) or save_params(), enable_input_caching, None)
-    enable_output_caching.change(lambda x: params.update({"enable_output_caching": x}) or save_params(), enable_output_caching, None)
-    disable_split.change(lambda x: params.update({"disable_split": x}) or save_params(), disable_split, None)
-    disable_newline_replacement.change(lambda x: params.update({"disable_newline_replacement": x}) or save_params(), disable_newline_replacement, None)
-    preserve_formatting.change(lambda x: params.update({"preserve_formatting": x}) or save_params(), preserve_formatting, None)
-    rtl_support.change(lambda x: params.update({"rtl_support": x}) or save_params(), rtl_support, None)
-
-    # Advanced settings
-    def update_special_symbol(x):
-        if not x:
-            raise gr.Error("Special symbol cannot be empty.")
-        params.update({"special_symbol": x})
-        save_params()
-    special_symbol.change(update_special_symbol, special_symbol, None)
-
-    def update_newline_symbol(x):
-        if not x:
-            raise gr.Error("Newline symbol cannot be empty.")
-        params.update({"newline_symbol": x})
-        save_params()
-    newline_symbol.change(update_newline_symbol, newline_symbol, None)
-
-    language.change(lambda x: params.update({"language string": language_codes[x]}) or save_params(), language, None)
-    engine.change(lambda x: params.update({"engine": engines[x]}) or save_params(), engine, None)
-    max_length.change(lambda x: params.update({"max_length": int(x)}) or save_params(), max_length, None)
-    translation_timeout.change(lambda x: params.update({"translation_timeout": int(x)}) or save_params(), translation_timeout, None)
-    debug.change(lambda x: params.update({"debug": x}) or save_params(), debug, None)
-
-    # Translator settings
-    LibreTranslateAPI.change(lambda x: params.update({"LibreTranslateAPI": x}) or save_params(), LibreTranslateAPI, None)
-    LibreTranslateAPIkey.change(lambda x: params.update({"LibreTranslateAPIkey": x}) or save_params(), LibreTranslateAPIkey, None)
-    DeeplAPIkey.change(lambda x: params.update({"DeeplAPIkey": x}) or save_params(), DeeplAPIkey, None)
-    DeeplFreeAPI.change(lambda x: params.update({"DeeplFreeAPI": x}) or save_params(), DeeplFreeAPI, None)
-
-def preserve_text_formatting(text, special_symbol):
-    """
-    Preserve formatting elements like bold, italic, links, etc. by replacing them with placeholders
-    Returns the modified text and a dictionary of placeholders to restore later
-    """
-    placeholders = {}
-    
-    # Define patterns to match common formatting
-    patterns = [
-        # Markdown/Discord style formatting
-        (r'\*\*(.*?)\*\*', r'<b>\1</b>'),  # Bold
-        (r'\*(.*?)\*', r'<i>\1</i>'),      # Italic
-        (r'__(.*?)__', r'<u>\1</u>'),      # Underline
-        (r'~~(.*?)~~', r'<s>\1</s>'),      # Strikethrough
-        (r'```(.*?)```', r'<code>\1</code>'),  # Code block
-        (r'`(.*?)`', r'<code>\1</code>'),  # Inline code
-        
-        # HTML style formatting (already in the text)
-        (r'<b>(.*?)</b>', r'<b>\1</b>'),
-        (r'<i>(.*?)</i>', r'<i>\1</i>'),
-        (r'<u>(.*?)</u>', r'<u>\1</u>'),
-        (r'<s>(.*?)</s>', r'<s>\1</s>'),
-        (r'<code>(.*?)</code>', r'<code>\1</code>'),
-        
-        # Links
-        (r'\[(.*?)\]\((.*?)\)', r'<a href="\2">\1</a>'),  # Markdown links
-        (r'<a\s+href=[\'"]([^\'"]*)[\'"]>(.*?)</a>', r'<a href="\1">\2</a>')  # HTML links
-    ]
-    
-    # Process each pattern
-    for pattern, replacement in patterns:
-        matches = re.finditer(pattern, text, re.DOTALL)
-        for match in matches:
-            # Generate a unique placeholder
-            placeholder_id = str(uuid.uuid4())
-            placeholder = f"{special_symbol}PLACEHOLDER_{placeholder_id}{special_symbol}"
-            
-            # Store the original formatted text
-            if '<' in replacement and '>' in replacement:
-                # It's an HTML tag pattern
-                content = match.group(1)
-                formatted_text = replacement.replace(r'\1', content)
-            else:
-                # It's the original matched text
-                formatted_text = match.group(0)
-                
-            placeholders[placeholder] = formatted_text
-            
-            # Replace in the text
-            text = text.replace(match.group(0), placeholder, 1)
-    
-    return text, placeholders
-
-def restore_text_formatting(text, placeholders):
-    """
-    Restore formatting elements from placeholders
-    """
-    for placeholder, original in placeholders.items():
-        text = text.replace(placeholder, original)
-    return text
+import html
+import gradio as gr
+from extensions.google_translate_plus.lang_codes import language_codes, language_names
+from extensions.google_translate_plus.lang_detect import base_language, detect_language, has_letters
+import json
+import os
+import re
+import concurrent.futures
+import functools
+import bisect
+import contextlib
+import copy
+import hashlib
+import heapq
+import importlib
+import importlib.util
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+import atexit
+import sys
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from types import MappingProxyType
+
+settings_path = "extensions/google_translate_plus/settings.json"
+cache_path = os.path.join(os.path.dirname(settings_path), "translation_cache.sqlite3")
+
+default_params = {
+    "Translate_user_input": True,
+    "Translate_system_output": True,
+    "language string": "ru",
+    "debug": False,
+    "special_symbol": "~",
+    "newline_symbol": "@",
+    "engine": "google",
+    "LibreTranslateAPI": "http://localhost:5000/",
+    "LibreTranslateAPIkey": "",
+    "DeeplAPIkey": "",
+    "DeeplFreeAPI": True,
+    "max_length": 1500,
+    "disable_split": False,
+    "disable_newline_replacement": False,
+    "enable_input_caching": True,
+    "enable_output_caching": True,
+    "translation_timeout": 10,
+    "preserve_formatting": True,
+    "rtl_support": True,
+    "skip_same_language": True,
+    "cache_max_entries": 1000,
+    "cache_max_size_mb": 16,
+    "enable_disk_cache": False,
+    "enable_translation_memory": True,
+    "translation_memory_max_entries": 5000,
+    "fuzzy_match_threshold": 0,
+    "max_concurrent_requests": 4,
+    "message_timeout": 30,
+    "retry_backoff": 0.5,
+    "stream_output_translation": False,
+    "metrics_export_path": "",
+    "metrics_export_format": "json",
+    "fallback_engines": [],
+    "hedge_requests": True,
+    "hedge_percentile": 95,
+    "circuit_breaker_failures": 3,
+    "circuit_breaker_cooldown": 60,
+    "rate_limits": {
+        "google": {"requests_per_second": 5, "chars_per_minute": 0, "max_concurrency": 8},
+        "deepl": {"requests_per_second": 5, "chars_per_minute": 0, "max_concurrency": 8},
+        "libre": {"requests_per_second": 0, "chars_per_minute": 0, "max_concurrency": 4}
+    },
+    "local_model": "Helsinki-NLP/opus-mt-{source}-{target}",
+    "local_model_device": "cpu",
+    "local_model_batch_size": 16,
+    "local_model_workers": 1,
+    "warmup_on_startup": True,
+    "glossary": []
+}
+
+def load_settings():
+    """Read settings.json, filling in defaults for missing keys"""
+    with open(settings_path, "r") as file:
+        settings = json.load(file)
+    for key in default_params:
+        if key not in settings:
+            settings[key] = copy.deepcopy(default_params[key])
+    return settings
+
+def write_settings(settings):
+    """Write settings.json atomically: a temporary file is written, flushed and renamed over it"""
+    temp_path = settings_path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(settings, file, ensure_ascii=False, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, settings_path)
+
+# Filled from settings.json by setup()
+params = copy.deepcopy(default_params)  # a deep copy: settings edits must not change the defaults
+
+# Display name -> engine name of the engines offered in the UI, filled by register_engine()
+engines = {}
+
+# Shared worker pool for engine calls. It is larger than max_concurrent_requests so that
+# abandoned calls that are still hanging do not starve new messages.
+TRANSLATION_POOL_SIZE = 16
+translation_pool = None
+translation_pool_lock = threading.Lock()
+RETRY_BACKOFF_CAP = 8
+HEDGE_MIN_DELAY = 0.25
+HEDGE_DEFAULT_DELAY = 1.0  # used until an engine has latency samples
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+engine_throttles = {}
+THROTTLE_LATENCY_GROWTH = 3
+THROTTLE_LATENCY_SAMPLES = 50  # per request size class
+THROTTLE_MIN_SAMPLES = 5
+ENGINE_DEFAULT_CONCURRENCY = 8  # for engines without a max_concurrency rate limit
+CIRCUIT_TRIAL_POLL_INTERVAL = 0.1
+THROTTLE_STATUS_CODES = (429, 529)  # not DeepL's 456 (quota exceeded), which lasts until the quota resets
+METRICS_EXPORT_INTERVAL = 15
+SETTINGS_SAVE_DELAY = 1.0  # seconds without changes before settings.json is written
+SETTINGS_POLL_INTERVAL = 2.0
+MAX_SESSIONS = 256
+
+# Translation backends by engine name, see register_engine()
+engine_registry = {}
+http_session = None
+translator_clients = threading.local()
+LOCAL_MODEL_BATCH_WAIT = 0.01  # how long the local model waits for concurrent requests to join a batch
+LOCAL_MODEL_MAX_LOADED = 2
+LOCAL_MODEL_MAX_TOKENS = 512
+
+# Engine capability metadata, rebuilt in the background at most once per ENGINE_INFO_TTL seconds
+RTL_LANGUAGES = frozenset(['ar', 'he', 'iw', 'fa', 'ur', 'yi', 'ckb', 'sd', 'ug', 'ps'])
+ENGINE_INFO_TTL = 3600
+ENGINE_INFO_RETRY_TTL = 60
+engine_info = {}  # engine -> (expiry, info)
+engine_info_locks = {}  # engine -> lock held while its entry is rebuilt
+engine_info_lock = threading.Lock()  # guards engine_info_locks
+
+class TranslationThrottled(Exception):
+    """The engine rejected a request because of its rate limits"""
+
+def is_throttling_error(e):
+    if isinstance(e, TranslationThrottled):
+        return True
+    # deep_translator is imported on first use; if it has not been, it cannot have raised
+    exceptions = sys.modules.get('deep_translator.exceptions')
+    if exceptions is not None and isinstance(e, exceptions.TooManyRequests):
+        return True
+    message = str(e)
+    return "TOO_MANY_REQUESTS" in message or "429" in message
+
+class TranslationCache:
+    """
+    Two-tier translation cache: a bounded in-memory LRU in front of an optional SQLite store.
+    The disk tier survives restarts; entries found there are promoted back into memory.
+    """
+    DISK_MAX_ENTRIES = 50000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.max_entries = 1000
+        self.max_bytes = 16 * 1024 * 1024
+        self.db = None
+        self.db_path = None
+        self.disk_writes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, max_entries, max_bytes, db_path=None):
+        with self.lock:
+            self.max_entries = max(0, int(max_entries))
+            self.max_bytes = max(0, int(max_bytes))
+            self._evict()
+            if db_path != self.db_path:
+                if self.db is not None:
+                    self.db.close()
+                    self.db = None
+                self.db_path = db_path
+                if db_path:
+                    try:
+                        self.db = sqlite3.connect(db_path, check_same_thread=False)
+                        self.db.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+                        self.db.commit()
+                    except sqlite3.Error as e:
+                        print(f"[Google translate plus]: Warning: could not open the translation cache database: {e}")
+                        self.db = None
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            if self.db is not None:
+                try:
+                    row = self.db.execute("SELECT value FROM translations WHERE key = ?", (key,)).fetchone()
+                except sqlite3.Error:
+                    row = None
+                if row is not None:
+                    self.disk_hits += 1
+                    self._store(key, row[0])
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self._store(key, value)
+            if self.db is not None:
+                try:
+                    self.db.execute("INSERT OR REPLACE INTO translations (key, value, created) VALUES (?, ?, ?)", (key, value, time.time()))
+                    self.disk_writes += 1
+                    if self.disk_writes % 1000 == 0:
+                        # Keep the disk tier bounded by dropping the oldest rows
+                        self.db.execute("DELETE FROM translations WHERE key IN (SELECT key FROM translations ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.DISK_MAX_ENTRIES,))
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    print(f"[Google translate plus]: Warning: could not write to the translation cache database: {e}")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.reset_stats()
+            if self.db is not None:
+                try:
+                    self.db.execute("DELETE FROM translations")
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    print(f"[Google translate plus]: Warning: could not clear the translation cache database: {e}")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "disk": self.db is not None,
+            }
+
+    def _store(self, key, value):
+        if key in self.entries:
+            self.size -= self._entry_size(key, self.entries.pop(key))
+        self.entries[key] = value
+        self.size += self._entry_size(key, value)
+        self._evict()
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            key, value = self.entries.popitem(last=False)
+            self.size -= self._entry_size(key, value)
+            self.evictions += 1
+
+    @staticmethod
+    def _entry_size(key, value):
+        return len(key) + len(value.encode('utf-8'))
+
+class TranslationMemory:
+    """
+    Line-level translation memory
+
+    Translations are remembered per line (the text between newline markers) for each engine,
+    language pair and endpoint, so a regenerated or edited message only sends the lines that
+    changed. With fuzzy matching, a MinHash LSH index over character trigrams also finds
+    remembered lines that are nearly identical; a candidate is reused when the Jaccard similarity
+    of the trigram sets reaches the threshold.
+    """
+    SHINGLE_SIZE = 3
+    BANDS = 8
+    ROWS = 4
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, max_entries=5000):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (context, line) -> (translation, MinHash signature or None)
+        self.buckets = {}  # (context, band, band values) -> set of lines
+        generator = random.Random(0)
+        self.permutations = [(generator.randrange(1, self.PRIME), generator.randrange(self.PRIME)) for _ in range(self.BANDS * self.ROWS)]
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+
+    def configure(self, max_entries):
+        with self.lock:
+            self.max_entries = max(0, int(max_entries))
+            self._evict()
+
+    @staticmethod
+    def normalize(line):
+        return " ".join(unicodedata.normalize('NFC', line).split())
+
+    def shingles(self, line):
+        if len(line) <= self.SHINGLE_SIZE:
+            return {line}
+        return {line[i:i + self.SHINGLE_SIZE] for i in range(len(line) - self.SHINGLE_SIZE + 1)}
+
+    def signature(self, shingles):
+        hashes = [hash(shingle) & self.PRIME for shingle in shingles]
+        return tuple(min((a * h + b) % self.PRIME for h in hashes) for a, b in self.permutations)
+
+    def bands(self, context, signature):
+        return [(context, band, signature[band * self.ROWS:(band + 1) * self.ROWS]) for band in range(self.BANDS)]
+
+    def get(self, context, line, threshold=0):
+        """
+        Remembered translation of line, or None
+
+        Args:
+            context: Engine, language pair and settings the translation belongs to
+            line: The line to translate
+            threshold: Minimum similarity (0-1) for reusing the translation of a similar line; 0 disables fuzzy matching
+        """
+        line = self.normalize(line)
+        with self.lock:
+            entry = self.entries.get((context, line))
+            if entry is not None:
+                self.entries.move_to_end((context, line))
+                self.hits += 1
+                return entry[0]
+        if threshold and len(line) > self.SHINGLE_SIZE:
+            # The signature is computed outside the lock
+            shingles = self.shingles(line)
+            signature = self.signature(shingles)
+            with self.lock:
+                candidates = set()
+                for bucket in self.bands(context, signature):
+                    candidates.update(self.buckets.get(bucket, ()))
+                best, best_similarity = None, threshold
+                for candidate in candidates:
+                    other = self.shingles(candidate)
+                    similarity = len(shingles & other) / len(shingles | other)
+                    if similarity >= best_similarity:
+                        best, best_similarity = candidate, similarity
+                if best is not None:
+                    self.entries.move_to_end((context, best))
+                    self.fuzzy_hits += 1
+                    return self.entries[(context, best)][0]
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, context, line, translation, index=False):
+        """Remember the translation of line; index also adds it to the fuzzy index"""
+        line = self.normalize(line)
+        translation = translation.strip()
+        if not line or not translation:
+            return
+        signature = self.signature(self.shingles(line)) if index and len(line) > self.SHINGLE_SIZE else None
+        with self.lock:
+            self._remove((context, line))
+            self.entries[(context, line)] = (translation, signature)
+            if signature is not None:
+                for bucket in self.bands(context, signature):
+                    self.buckets.setdefault(bucket, set()).add(line)
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.buckets.clear()
+            self.reset_stats()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.fuzzy_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "fuzzy_hits": self.fuzzy_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.fuzzy_hits) / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[1] is not None:
+            for bucket in self.bands(key[0], entry[1]):
+                lines = self.buckets.get(bucket)
+                if lines is not None:
+                    lines.discard(key[1])
+                    if not lines:
+                        del self.buckets[bucket]
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+translation_cache = TranslationCache()
+translation_memory = TranslationMemory()
+
+def configure_cache():
+    """Apply the cache settings from params to the shared translation cache and translation memory"""
+    translation_cache.configure(
+        params.get('cache_max_entries', 1000),
+        params.get('cache_max_size_mb', 16) * 1024 * 1024,
+        cache_path if params.get('enable_disk_cache', False) else None
+    )
+    translation_memory.configure(params.get('translation_memory_max_entries', 5000))
+
+def cache_key(string, sourcelang, targetlang, settings=None):
+    """
+    Build a cache key from the engine, language pair, normalized text and every setting that affects the result
+    """
+    if settings is None:
+        settings = get_settings()
+    engine = settings.get('engine', 'google')
+    key = [
+        engine,
+        sourcelang,
+        targetlang,
+        unicodedata.normalize('NFC', string),  # whitespace included: the translation keeps it
+        settings.get('special_symbol', '~'),
+        settings.get('newline_symbol', '@'),
+        settings.get('max_length', 1500),
+        settings.get('disable_split', False),
+        settings.get('disable_newline_replacement', False),
+        settings.get('preserve_formatting', True),
+        settings.get('rtl_support', True),
+        list(settings.get('glossary', ())),
+    ]
+    if engine in engine_registry:
+        key.extend(engine_registry[engine].cache_context(settings))
+    return hashlib.sha256(json.dumps(key, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def memory_context(engine, sourcelang, targetlang, settings):
+    """The part of a translation memory key that is not the line itself"""
+    context = (engine, sourcelang, targetlang, settings.get('newline_symbol', '@'))
+    if engine in engine_registry:
+        context += engine_registry[engine].cache_context(settings)
+    return context
+
+def format_cache_stats():
+    stats = translation_cache.stats()
+    memory = translation_memory.stats()
+    return (f"**Cache:** {stats['entries']} entries, {stats['bytes'] / 1024:.1f} KiB in memory"
+            f"{' + disk' if stats['disk'] else ''}  \n"
+            f"**Hits:** {stats['hits']} memory, {stats['disk_hits']} disk | **Misses:** {stats['misses']} | "
+            f"**Hit rate:** {stats['hit_rate']:.0%} | **Evictions:** {stats['evictions']}  \n"
+            f"**Translation memory:** {memory['entries']} lines | **Hits:** {memory['hits']} exact, {memory['fuzzy_hits']} fuzzy | "
+            f"**Misses:** {memory['misses']} | **Hit rate:** {memory['hit_rate']:.0%}")
+
+def input_modifier(string, state=None, is_chat=False):
+    settings = get_settings()
+    if not settings.get('Translate_user_input', True):
+        if settings.get('debug', False):
+            print("[Google translate plus]: Input text translation disabled")
+        return string
+
+    return translate_text(string, settings.get('language string', 'ru'), "en", use_cache=settings.get('enable_input_caching', True))
+
+def output_modifier(string, state=None, is_chat=False):
+    settings = get_settings()
+    if not settings.get('Translate_system_output', True):
+        if settings.get('debug', False):
+            print("[Google translate plus]: Output text translation disabled")
+        return string
+
+    if settings.get('stream_output_translation', False):
+        return translate_stream(string, "en", settings.get('language string', 'ru'), use_cache=settings.get('enable_output_caching', True), session=session_id(state))
+
+    return translate_text(string, "en", settings.get('language string', 'ru'), use_cache=settings.get('enable_output_caching', True))
+
+# URLs and HTML tags, left out of language detection; protected spans are left out before
+DETECTION_NOISE_PATTERN = re.compile(r'https?://\S+|<[^>\n]+>')
+
+def skip_reason(string, targetlang, settings):
+    """
+    Why translating string can be skipped: nothing in it gets translated, or it is already in targetlang
+
+    Returns:
+        Reason for the debug log, or None if the text has to be translated
+    """
+    # Exactly the text protected_runs() would send, so a skip is never decided on protected text
+    text = " ".join(run for run, protected in protected_runs(string, settings) if not protected)
+    text = DETECTION_NOISE_PATTERN.sub(" ", text)
+    if not has_letters(text):
+        return "there is nothing to translate"
+    language = detect_language(text)
+    if language is not None and language == base_language(targetlang):
+        return f"the text is already in {targetlang}"
+    return None
+
+def session_id(state):
+    """The chat a modifier call belongs to, taken from the webui state"""
+    if not state:
+        return None
+    return state.get('unique_id') or state.get('character_menu') or None
+
+class TranslationMetrics:
+    """
+    Thread-safe timings of the translate_text stages and per-engine counters
+
+    Every stage and every engine keeps its count, total and maximum, plus a window of recent
+    samples for percentiles.
+    """
+    SAMPLES = 512
+    COUNTERS = ("messages", "requests", "chars", "cache_hits", "cache_misses", "retries", "hedges", "timeouts", "throttled", "failures", "coalesced", "skipped")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.engines = {}
+            self.started = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start)
+
+    def record_stage(self, name, seconds):
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = {"count": 0, "total": 0.0, "max": 0.0, "samples": deque(maxlen=self.SAMPLES)}
+            self._add(stats, seconds)
+
+    def record_request(self, engine, seconds):
+        """Latency of one engine call"""
+        with self.lock:
+            self._add(self._engine(engine)["latency"], seconds)
+
+    def count(self, engine, counter, amount=1):
+        with self.lock:
+            self._engine(engine)["counters"][counter] += amount
+
+    def latency_percentile(self, engine, percent):
+        """Recent engine call latency at the given percentile, or None without samples"""
+        with self.lock:
+            stats = self.engines.get(engine)
+            samples = sorted(stats["latency"]["samples"]) if stats else []
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime": time.time() - self.started,
+                "stages": {name: self._summary(stats) for name, stats in self.stages.items()},
+                "engines": {
+                    engine: dict(stats["counters"], latency=self._summary(stats["latency"]))
+                    for engine, stats in self.engines.items()
+                },
+            }
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        prefix = "google_translate_plus"
+        lines.append(f"# TYPE {prefix}_stage_seconds summary")
+        for name, stats in snapshot["stages"].items():
+            for quantile in ("p50", "p95", "p99"):
+                lines.append(f'{prefix}_stage_seconds{{stage="{name}",quantile="0.{quantile[1:]}"}} {stats[quantile]:.6f}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stats["total"]:.6f}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stats["count"]}')
+        for counter in self.COUNTERS:
+            lines.append(f"# TYPE {prefix}_{counter}_total counter")
+            for engine, stats in snapshot["engines"].items():
+                lines.append(f'{prefix}_{counter}_total{{engine="{engine}"}} {stats[counter]}')
+        lines.append(f"# TYPE {prefix}_request_seconds summary")
+        for engine, stats in snapshot["engines"].items():
+            lines.append(f'{prefix}_request_seconds_sum{{engine="{engine}"}} {stats["latency"]["total"]:.6f}')
+            lines.append(f'{prefix}_request_seconds_count{{engine="{engine}"}} {stats["latency"]["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def _engine(self, engine):
+        stats = self.engines.get(engine)
+        if stats is None:
+            stats = self.engines[engine] = {
+                "counters": dict.fromkeys(self.COUNTERS, 0),
+                "latency": {"count": 0, "total": 0.0, "max": 0.0, "samples": deque(maxlen=self.SAMPLES)},
+            }
+        return stats
+
+    @staticmethod
+    def _add(stats, seconds):
+        stats["count"] += 1
+        stats["total"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+        stats["samples"].append(seconds)
+
+    @staticmethod
+    def _summary(stats):
+        samples = sorted(stats["samples"])
+        pick = lambda percent: samples[min(len(samples) - 1, int(len(samples) * percent / 100))] if samples else 0.0
+        return {
+            "count": stats["count"],
+            "total": stats["total"],
+            "mean": stats["total"] / stats["count"] if stats["count"] else 0.0,
+            "max": stats["max"],
+            "p50": pick(50),
+            "p95": pick(95),
+            "p99": pick(99),
+        }
+
+translation_metrics = TranslationMetrics()
+metrics_exporter = None
+
+def export_metrics():
+    """Write the metrics snapshot to metrics_export_path, replacing the file atomically"""
+    path = params.get('metrics_export_path', "")
+    if not path:
+        return
+    if params.get('metrics_export_format', 'json') == 'prometheus':
+        content = translation_metrics.to_prometheus()
+    else:
+        content = json.dumps(translation_metrics.snapshot(), indent=4)
+    try:
+        with open(path + ".tmp", "w") as file:
+            file.write(content)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"[Google translate plus]: Warning: could not export metrics to {path}: {e}")
+
+def start_metrics_exporter():
+    """Start the background thread that periodically exports metrics, if an export file is set"""
+    global metrics_exporter
+    if not params.get('metrics_export_path', "") or (metrics_exporter is not None and metrics_exporter.is_alive()):
+        return
+
+    def run():
+        while params.get('metrics_export_path', ""):
+            export_metrics()
+            time.sleep(METRICS_EXPORT_INTERVAL)
+
+    metrics_exporter = threading.Thread(target=run, name="google_translate_plus_metrics", daemon=True)
+    metrics_exporter.start()
+
+def format_metrics():
+    snapshot = translation_metrics.snapshot()
+    lines = ["| Stage | Count | Mean ms | p95 ms | Max ms |", "|---|---|---|---|---|"]
+    for name, stats in snapshot["stages"].items():
+        lines.append(f"| {name} | {stats['count']} | {stats['mean'] * 1000:.2f} | {stats['p95'] * 1000:.2f} | {stats['max'] * 1000:.2f} |")
+    lines += ["", "| Engine | Messages | Skipped | Coalesced | Requests | Chars | Cache hits | Cache misses | Retries | Hedges | Timeouts | Throttled | Failures | p95 request ms | Concurrency | Circuit |",
+              "|---|---|---|---|---|---|---|---|---|---|---|---|---|---|---|---|"]
+    for engine, stats in snapshot["engines"].items():
+        lines.append(f"| {engine} | {stats['messages']} | {stats['skipped']} | {stats['coalesced']} | {stats['requests']} | {stats['chars']} | {stats['cache_hits']} | {stats['cache_misses']} | "
+                     f"{stats['retries']} | {stats['hedges']} | {stats['timeouts']} | {stats['throttled']} | {stats['failures']} | "
+                     f"{stats['latency']['p95'] * 1000:.0f} | {get_engine_throttle(engine).limit:.1f} | {get_circuit_breaker(engine).state} |")
+    return "\n".join(lines)
+
+class OutputStream:
+    """Progress of the reply that is currently being streamed in one chat"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.source = ""
+        self.committed = 0  # length of the source prefix that has been translated
+        self.translated = []
+        self.tail = ("", "")  # the uncommitted rest of the source and its translation
+
+def freeze_settings(value):
+    """Read-only deep copy of a settings value: dicts become mapping proxies and lists become tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze_settings(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_settings(item) for item in value)
+    return value
+
+class CompiledSettings(Mapping):
+    """
+    Immutable snapshot of params, with the regular expressions that depend on the settings
+    compiled once per snapshot instead of on every translation
+    """
+    __slots__ = ('_values', 'span_pattern', 'glossary', 'newline_pattern', 'newline_split_pattern')
+
+    def __init__(self, values):
+        set_attribute = super().__setattr__
+        values = freeze_settings(values)
+        set_attribute('_values', values)
+        newline_symbol = values.get('newline_symbol', '@')
+        set_attribute('span_pattern', span_pattern(values.get('special_symbol', '~') or '~', values.get('preserve_formatting', True)))
+        set_attribute('glossary', compile_glossary(values.get('glossary', ())))
+        set_attribute('newline_pattern', re.compile(r'\s*{}\s*'.format(re.escape(newline_symbol))))
+        set_attribute('newline_split_pattern', newline_split_pattern(newline_symbol))
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("settings snapshots are read-only")
+
+class TranslationService:
+    """
+    Thread-safe entry point for translations, shared by all chats
+
+    Translations read an immutable CompiledSettings snapshot of params without taking a lock;
+    update_settings() publishes a new one whenever the settings are saved, together with a copy
+    without RTL markers for the parts of streamed replies. Streaming progress is
+    kept per session, so concurrent chats do not overwrite each other's replies, and identical
+    requests (same engine, language pair, text and settings) that are in flight at the same time
+    share a single translation.
+    """
+    def __init__(self, max_sessions=MAX_SESSIONS):
+        self.lock = threading.Lock()
+        self._snapshots = None
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # session id -> OutputStream, least recently used first
+        self.in_flight = {}  # cache key -> Future of the translation in progress
+
+    @property
+    def snapshots(self):
+        """(settings, settings for streamed parts), published together"""
+        snapshots = self._snapshots
+        if snapshots is None:
+            self.update_settings()
+            snapshots = self._snapshots
+        return snapshots
+
+    @property
+    def settings(self):
+        return self.snapshots[0]
+
+    def update_settings(self):
+        """Publish a snapshot of the current params"""
+        with self.lock:
+            self._snapshots = (CompiledSettings(params), CompiledSettings(dict(params, rtl_support=False)))
+            return self._snapshots[0]
+
+    def stream(self, session):
+        """The OutputStream of a session, created on first use"""
+        with self.lock:
+            stream = self.sessions.get(session)
+            if stream is None:
+                stream = self.sessions[session] = OutputStream()
+                if len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            else:
+                self.sessions.move_to_end(session)
+            return stream
+
+    def translate(self, string, sourcelang, targetlang, use_cache=False, settings=None):
+        """
+        Translate text, serving repeated requests from the translation cache and joining an
+        identical translation that is already in flight
+
+        Args:
+            settings: Snapshot to translate with instead of the current settings
+
+        Returns:
+            Translated text or original text if translation fails
+        """
+        if settings is None:
+            settings = self.settings
+        engine = settings.get('engine', 'google')
+        if settings.get('skip_same_language', True):
+            reason = skip_reason(string, targetlang, settings)
+            if reason is not None:
+                translation_metrics.count(engine, "skipped")
+                if settings.get('debug', False):
+                    print(f"[Google translate plus]: Skipping translation, {reason}")
+                return string
+
+        key = cache_key(string, sourcelang, targetlang, settings)
+        if use_cache:
+            cached = translation_cache.get(key)
+            if cached is not None:
+                translation_metrics.count(engine, "cache_hits")
+                if settings.get('debug', False):
+                    print("[Google translate plus]: Using cached translation")
+                return cached
+            translation_metrics.count(engine, "cache_misses")
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = concurrent.futures.Future()
+        if not leader:
+            translation_metrics.count(engine, "coalesced")
+            if settings.get('debug', False):
+                print("[Google translate plus]: Waiting for an identical translation in progress")
+            try:
+                return future.result(timeout=settings.get('message_timeout', 30))
+            except concurrent.futures.TimeoutError:
+                return string
+
+        try:
+            translation_metrics.count(engine, "messages")
+            with translation_metrics.stage("total"):
+                translated_text = _translate_text(string, sourcelang, targetlang, settings)
+            if translated_text is None:
+                translated_text = string
+            elif use_cache:
+                translation_cache.put(key, translated_text)
+            future.set_result(translated_text)
+            return translated_text
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+    def translate_many(self, strings, sourcelang, targetlang, use_cache=False):
+        """
+        Translate several texts together, packing the parts of all of them into as few engine
+        requests as the engine's batch limits allow
+
+        Texts are skipped, served from the translation cache and stored in it exactly as with
+        translate(), so the results also serve later translate() calls of the same texts.
+
+        Returns:
+            List of translated texts in input order, with None for the texts whose translation failed
+        """
+        settings = self.settings
+        engine = settings.get('engine', 'google')
+        results = list(strings)
+        pending = {}  # cache key -> (indices of the texts, prepared translation)
+        for idx, string in enumerate(strings):
+            if settings.get('skip_same_language', True) and skip_reason(string, targetlang, settings) is not None:
+                translation_metrics.count(engine, "skipped")
+                continue
+            key = cache_key(string, sourcelang, targetlang, settings)
+            if use_cache:
+                cached = translation_cache.get(key)
+                if cached is not None:
+                    translation_metrics.count(engine, "cache_hits")
+                    results[idx] = cached
+                    continue
+                translation_metrics.count(engine, "cache_misses")
+            if key in pending:
+                translation_metrics.count(engine, "coalesced")
+                pending[key][0].append(idx)
+                continue
+            prepared = prepare_translation(string, sourcelang, targetlang, settings)
+            if prepared is not None:
+                pending[key] = ([idx], prepared)
+        if not pending:
+            return results
+
+        translation_metrics.count(engine, "messages", len(pending))
+        texts = [text for _, (parts, _) in pending.values() for text in parts]
+        deadline = time.monotonic() + settings.get('message_timeout', 30)
+        try:
+            with translation_metrics.stage("engine calls"):
+                translated_texts = translate_segments(texts, sourcelang, targetlang, engine, settings.get('translation_timeout', 10), deadline, settings)
+        except Exception as e:
+            print(f"[Google translate plus]: An error occurred during translation: {e}")
+            translated_texts = None
+        if translated_texts is None:
+            if settings.get('debug', False):
+                print(f"[Google translate plus]: Translation of {len(pending)} texts failed")
+            for indices, _ in pending.values():
+                for idx in indices:
+                    results[idx] = None
+            return results
+
+        position = 0
+        for key, (indices, (parts, finish)) in pending.items():
+            translated_text = finish(translated_texts[position:position + len(parts)])
+            position += len(parts)
+            if use_cache:
+                translation_cache.put(key, translated_text)
+            for idx in indices:
+                results[idx] = translated_text
+        return results
+
+    def translate_stream(self, string, sourcelang, targetlang, use_cache=False, session=None):
+        """
+        Incrementally translate a reply that is being streamed
+
+        Every call receives the whole reply generated so far. Sentences and paragraphs that have been
+        completed since the previous call are translated once and appended to the translated prefix.
+        The unfinished tail is translated on every call, but not kept, since it may still grow; the
+        reply is complete whenever the caller stops calling. The RTL markers are added once around
+        the whole reply.
+
+        Returns:
+            Translated reply
+        """
+        settings, stream_settings = self.snapshots
+        stream = self.stream(session)
+        with stream.lock:
+            if not string.startswith(stream.source[:stream.committed]):
+                # A new reply, or the previous one was edited or regenerated
+                stream.committed = 0
+                stream.translated = []
+                stream.tail = ("", "")
+            stream.source = string
+
+            end = stream.committed + find_stream_boundary(string[stream.committed:], stream_settings)
+            if end > stream.committed:
+                stream.translated.append(self.translate_piece(string[stream.committed:end], sourcelang, targetlang, use_cache, stream_settings))
+                stream.committed = end
+
+            tail = string[stream.committed:]
+            if tail != stream.tail[0]:
+                # Not cached: a partial sentence is rarely seen again
+                stream.tail = (tail, self.translate_piece(tail, sourcelang, targetlang, False, stream_settings))
+            translated_text = "".join(stream.translated) + stream.tail[1]
+
+        engine = settings.get('engine', 'google')
+        if translated_text.strip() and settings.get('rtl_support', True) and targetlang in get_engine_info(engine)['rtl_languages']:
+            translated_text = f"\u202B{translated_text}\u202C"
+        return translated_text
+
+    def translate_piece(self, segment, sourcelang, targetlang, use_cache, settings):
+        """Translate a part of a streamed reply, keeping its surrounding whitespace"""
+        content = segment.strip()
+        if not content:
+            return segment
+        leading = segment[:len(segment) - len(segment.lstrip())]
+        trailing = segment[len(segment.rstrip()):]
+        return leading + self.translate(content, sourcelang, targetlang, use_cache=use_cache, settings=settings) + trailing
+
+translation_service = TranslationService()
+
+def get_settings():
+    """The current read-only settings snapshot"""
+    return translation_service.settings
+
+def translate_text(string, sourcelang, targetlang, use_cache=False):
+    """
+    Translate text, serving repeated requests from the translation cache
+
+    Args:
+        string: The text to translate
+        sourcelang: Source language code
+        targetlang: Target language code
+        use_cache: Whether to look up and store the result in the translation cache
+
+    Returns:
+        Translated text or original text if translation fails
+    """
+    return translation_service.translate(string, sourcelang, targetlang, use_cache=use_cache)
+
+def translate_many(strings, sourcelang, targetlang, use_cache=False):
+    """Translate several texts with batched engine requests; see TranslationService.translate_many"""
+    return translation_service.translate_many(strings, sourcelang, targetlang, use_cache=use_cache)
+
+def translate_stream(string, sourcelang, targetlang, use_cache=False, session=None):
+    """Incrementally translate the reply streamed in session; see TranslationService.translate_stream"""
+    return translation_service.translate_stream(string, sourcelang, targetlang, use_cache=use_cache, session=session)
+
+@functools.lru_cache(maxsize=8)
+def stream_opener_pattern(special_symbol, preserve_formatting):
+    """
+    Compiled pattern matching what may open a protected span whose end has not been streamed yet.
+    The multiline group matches code fences and HTML elements, which can span lines.
+    """
+    alternatives = [re.escape(special_symbol), r'\{\{']
+    if preserve_formatting:
+        alternatives = [r'(?P<multiline>```|<(?:b|i|u|s|code)>|<a\s)', r'`', r'\*', r'__', r'~~', r'\['] + alternatives
+    return re.compile("|".join(alternatives))
+
+def find_stream_boundary(text, settings):
+    """
+    Return the length of the completed sentences and paragraphs at the start of text
+
+    Only boundaries outside protected spans count, and none after a span that may still be open:
+    a code fence or HTML element without its end, or another span opener on the last line.
+    """
+    starts = []
+    ends = []
+    limit = len(text)
+    position = 0
+    opener = stream_opener_pattern(settings.get('special_symbol', '~') or '~', settings.get('preserve_formatting', True))
+    for run, protected in protected_runs(text, settings):
+        if protected:
+            starts.append(position)
+            ends.append(position + len(run))
+        elif limit == len(text):
+            for match in opener.finditer(run):
+                if match.lastgroup == 'multiline' or "\n" not in text[position + match.end():]:
+                    limit = position + match.start()
+                    break
+        position += len(run)
+
+    end = 0
+    for match in boundary_pattern("\n").finditer(text, 0, limit):
+        idx = bisect.bisect_right(starts, match.start()) - 1
+        if idx < 0 or ends[idx] <= match.start():
+            end = match.end()
+    return end
+
+def _translate_text(string, sourcelang, targetlang, settings):
+    """
+    Main translation function that handles the translation process
+    
+    Args:
+        string: The text to translate
+        sourcelang: Source language code
+        targetlang: Target language code
+        settings: Settings snapshot used for the whole translation
+        
+    Returns:
+        Translated text or None if translation fails
+    """
+    deadline = time.monotonic() + settings.get('message_timeout', 30)
+    debug = settings.get('debug', False)
+    engine = settings.get('engine', 'google')
+    if debug:
+        print("\n------[Google translate plus debug info]-----")
+        print(f"[Google translate plus]: Using {engine.capitalize()} Translator...")
+
+    prepared = prepare_translation(string, sourcelang, targetlang, settings)
+    if prepared is None:
+        return None
+    texts, finish = prepared
+
+    try:
+        with translation_metrics.stage("engine calls"):
+            translated_texts = translate_segments(texts, sourcelang, targetlang, engine, settings.get('translation_timeout', 10), deadline, settings)
+    except Exception as e:
+        if debug:
+            print(f"[Google translate plus]: An error occurred during translation: {e}")
+        gr.warning(f"An error occurred during translation: {e}")
+        return None
+
+    if translated_texts is None:
+        if debug:
+            print("[Google translate plus]: Translation failed, returning original text")
+        gr.warning("Translation failed, returning original text")
+        return None  # Let the caller fall back to the original text
+
+    translated_text = finish(translated_texts)
+    if debug:
+        print("[Google translate plus]: The text has been successfully translated. Result:")
+        print("\033[32m" + translated_text + "\033[0m\n")
+        print("---------------------------------------------")
+    return translated_text
+
+def prepare_translation(string, sourcelang, targetlang, settings):
+    """
+    Split a message into the texts to send to the engine
+
+    Returns:
+        (texts, finish) where finish(translated_texts) reassembles the translated message,
+        or None if the settings are invalid
+    """
+    debug = settings.get('debug', False)
+    engine = settings.get('engine', 'google')
+    MAX_LEN = settings.get('max_length', 1500)
+    special_symbol = settings.get('special_symbol', '~')
+    newline_symbol = settings.get('newline_symbol', '@')
+    disable_split = settings.get('disable_split', False)
+    disable_newline_replacement = settings.get('disable_newline_replacement', False)
+    preserve_formatting = settings.get('preserve_formatting', True)
+    rtl_support = settings.get('rtl_support', True)
+    
+    info = get_engine_info(engine)
+    max_bytes = None
+    for name in engine_chain(engine, settings):
+        # Parts can fail over to any engine of the chain, so they have to fit all of them
+        max_request = get_engine_info(name)['max_request']
+        if max_request is None:
+            continue
+        if max_request['unit'] == 'bytes':
+            max_bytes = min(max_bytes or max_request['size'], max_request['size'])
+        else:
+            MAX_LEN = min(MAX_LEN, max_request['size'])
+
+    # Check if the target language is RTL
+    is_rtl = targetlang in info['rtl_languages']
+    
+    # Check if the language is supported by the selected engine
+    if debug and not is_language_supported(engine, targetlang):
+        print(f"[Google translate plus]: Warning - Language {targetlang} may not be supported by {engine.capitalize()} Translator")
+    
+    if debug:
+        print("[Google translate plus]: Translation parameters:")
+        print(f"  Special symbol: {special_symbol}")
+        print(f"  Newline symbol: {newline_symbol}")
+        print(f"  Disable split: {disable_split}")
+        print(f"  Disable newline replacement: {disable_newline_replacement}")
+        print(f"  Preserve formatting: {preserve_formatting}")
+        print(f"  RTL support: {rtl_support} (Target language is{' ' if is_rtl else ' not '}RTL)\n")
+        print("[Google translate plus]: The text is currently being translated:")
+        print("\033[32m" + string + "\033[0m\n")
+
+    # Validate special_symbol and newline_symbol
+    if not special_symbol:
+        if debug:
+            print("[Google translate plus]: Error: Special symbol cannot be empty.")
+        return None
+    if not newline_symbol:
+        if debug:
+            print("[Google translate plus]: Error: Newline symbol cannot be empty.")
+        return None
+        
+    # Protected spans are kept as they are and never sent; only the runs between them are translated
+    with translation_metrics.stage("protected spans"):
+        runs = protected_runs(string, settings)
+    split_start = time.perf_counter()
+    translated_runs = [run for run, _ in runs]
+    texts = []
+    pieces = []  # (run index, number of parts, leading whitespace, trailing whitespace)
+    for idx, (run, protected) in enumerate(runs):
+        if protected or not has_letters(run):
+            continue  # e.g. punctuation between two protected spans
+
+        # The whitespace around the run, newlines included, is kept as it is and not sent
+        body = run.strip()
+        if not disable_newline_replacement:
+            # Preserve newlines with a marker to ensure they're properly restored
+            body = body.replace("\n", f" {newline_symbol} ")
+
+        if disable_split:
+            parts = [body]
+        else:
+            # Pack whole sentences into as few parts as the length limits allow
+            parts = [body[start:end] for start, end in segment_text(body, MAX_LEN, newline_symbol, max_bytes)]
+        pieces.append((idx, len(parts), run[:len(run) - len(run.lstrip())], run[len(run.rstrip()):]))
+        texts.extend(parts)
+    translation_metrics.record_stage("escape and split", time.perf_counter() - split_start)
+
+    def finish(translated_texts):
+        bodies = []
+        position = 0
+        for _, count, _, _ in pieces:
+            bodies.append(" ".join(translated_texts[position:position + count]))
+            position += count
+
+        if not disable_newline_replacement:
+            # Improved newline restoration that preserves spacing
+            with translation_metrics.stage("newline restoration"):
+                bodies = [settings.newline_pattern.sub('\n', body) for body in bodies]
+
+        # Enhanced HTML entity handling, only in translated text: protected spans are kept verbatim
+        with translation_metrics.stage("html unescape"):
+            bodies = [html.unescape(body) for body in bodies]
+
+        # Reassemble the translated runs and the protected spans in their original order
+        with translation_metrics.stage("reassembly"):
+            for (idx, _, leading, trailing), body in zip(pieces, bodies):
+                translated_runs[idx] = leading + body + trailing
+            translated_text = "".join(translated_runs)
+
+        # Add RTL markers if needed and enabled
+        if rtl_support and is_rtl:
+            # Add RTL embedding controls for proper display
+            translated_text = f"\u202B{translated_text}\u202C"
+        return translated_text
+
+    return texts, finish
+
+def translate_segments(texts, sourcelang, targetlang, engine, timeout, deadline, settings):
+    """
+    Translate the parts of a message, reusing line translations from the translation memory
+
+    Each part is split into lines at its newline markers. Remembered lines are reused and the
+    others are sent together, still joined by newline markers; their translation is split back
+    into lines and remembered. A part whose translation comes back with a different number of
+    lines is translated again as a whole.
+
+    Returns:
+        List of translated parts in input order, or None if any part could not be translated
+    """
+    def send(batch):
+        return translate_joined(batch, sourcelang, targetlang, engine, timeout, deadline, settings)
+
+    if not settings.get('enable_translation_memory', True) or settings.get('disable_newline_replacement', False):
+        return send(texts)
+
+    newline_symbol = settings.get('newline_symbol', '@')
+    separator = f" {newline_symbol} "
+    pattern = settings.newline_split_pattern
+    context = memory_context(engine, sourcelang, targetlang, settings)
+    threshold = settings.get('fuzzy_match_threshold', 0)
+
+    plans = []  # (pieces, translated lines, indices of the lines to send) for each part
+    requests = []
+    with translation_metrics.stage("translation memory"):
+        for text in texts:
+            pieces = pattern.split(text)  # lines at even indices, newline markers at odd ones
+            lines = pieces[0::2]
+            translated_lines = []
+            for line in lines:
+                if not line.strip():
+                    translated_lines.append(line)
+                    continue
+                translated = translation_memory.get(context, line, threshold)
+                if translated is not None:
+                    # Keep the whitespace around the line
+                    translated = line[:len(line) - len(line.lstrip())] + translated + line[len(line.rstrip()):]
+                translated_lines.append(translated)
+            missing = [i for i, translated in enumerate(translated_lines) if translated is None]
+            if missing:
+                requests.append(separator.join(lines[i].strip() for i in missing))
+            plans.append((pieces, translated_lines, missing))
+
+    translated_requests = send(requests) if requests else []
+    if translated_requests is None:
+        return None
+
+    results = []
+    retranslate = []
+    position = 0
+    for idx, (pieces, translated_lines, missing) in enumerate(plans):
+        if missing:
+            translated = translated_requests[position]
+            position += 1
+            received = pattern.split(translated)[0::2]
+            if len(received) != len(missing):
+                # The engine merged or split lines
+                if len(missing) == len(translated_lines):
+                    results.append(translated)
+                else:
+                    retranslate.append(idx)
+                    results.append(None)
+                continue
+            for i, line in zip(missing, received):
+                source = pieces[2 * i]
+                translation_memory.put(context, source, line, index=threshold > 0)
+                translated_lines[i] = source[:len(source) - len(source.lstrip())] + line.strip() + source[len(source.rstrip()):]
+        pieces[0::2] = translated_lines
+        results.append("".join(pieces))
+
+    if retranslate:
+        translated = send([texts[idx] for idx in retranslate])
+        if translated is None:
+            return None
+        for idx, text in zip(retranslate, translated):
+            results[idx] = text
+    return results
+
+def translate_joined(texts, sourcelang, targetlang, engine, timeout, deadline, settings):
+    """
+    Translate texts, joining them with newline markers into as few requests as the request size
+    allows when the engine has no batch requests
+
+    Each joined translation is split back at its newline markers; a group whose translation comes
+    back with a different number of lines is translated again text by text.
+
+    Returns:
+        List of translated texts in input order, or None if any text could not be translated
+    """
+    info = get_engine_info(engine)
+    if len(texts) < 2 or info['batch'] or settings.get('disable_newline_replacement', False):
+        return translate_with_timeout(texts, sourcelang, targetlang, engine, timeout, deadline, settings)
+
+    separator = f" {settings.get('newline_symbol', '@')} "
+    pattern = settings.newline_split_pattern
+    limit = settings.get('max_length', 1500)
+    for name in engine_chain(engine, settings):
+        max_request_chars = get_engine_info(name)['max_request_chars']
+        if max_request_chars is not None:
+            limit = min(limit, max_request_chars)
+    groups = []
+    size = limit
+    for idx, text in enumerate(texts):
+        if size + len(separator) + len(text) > limit:
+            groups.append([])
+            size = -len(separator)
+        groups[-1].append(idx)
+        size += len(separator) + len(text)
+
+    translated = translate_with_timeout([separator.join(texts[idx] for idx in group) for group in groups],
+                                        sourcelang, targetlang, engine, timeout, deadline, settings)
+    if translated is None:
+        return None
+    results = [None] * len(texts)
+    retranslate = []
+    for group, joined in zip(groups, translated):
+        if len(group) == 1:
+            results[group[0]] = joined
+            continue
+        pieces = pattern.split(joined)  # lines at even indices, newline markers at odd ones
+        counts = [len(pattern.split(texts[idx])) for idx in group]
+        if len(pieces) != sum(counts) + len(group) - 1:
+            # The engine merged or split lines
+            retranslate.extend(group)
+            continue
+        position = 0
+        for idx, count in zip(group, counts):
+            results[idx] = "".join(pieces[position:position + count])
+            position += count + 1  # skip the separator
+    if retranslate:
+        translated = translate_with_timeout([texts[idx] for idx in retranslate], sourcelang, targetlang, engine, timeout, deadline, settings)
+        if translated is None:
+            return None
+        for idx, text in zip(retranslate, translated):
+            results[idx] = text
+    return results
+
+@functools.lru_cache(maxsize=8)
+def newline_split_pattern(newline_symbol):
+    """Newline markers with the whitespace around them, captured so that re.split keeps them"""
+    return re.compile(r'(\s*{}\s*)'.format(re.escape(newline_symbol)))
+
+@functools.lru_cache(maxsize=8)
+def boundary_pattern(newline_symbol):
+    """Compiled pattern matching paragraph and sentence boundaries, including CJK and Arabic punctuation"""
+    return re.compile("|".join([
+        re.escape(newline_symbol) + r'\s*',  # Paragraph (newline symbol)
+        r'\n\s*',                             # Paragraph (raw newline)
+        r'[.!?…]+["\'”’»)\]]*\s+',           # Sentence end followed by whitespace
+        r'[。！？]+[」』”’）]*\s*',            # CJK sentence end
+        r'[؟۔।॥]+\s*',                        # Arabic question mark, Urdu full stop, Devanagari danda
+    ]))
+
+def segment_text(text, max_length, newline_symbol, max_bytes=None):
+    """
+    Split text into parts of at most max_length characters (and max_bytes UTF-8 bytes, if given)
+
+    Makes one forward pass over the paragraph and sentence boundaries and packs whole sentences
+    greedily into each part. Sentences that are too long on their own are cut at the last space
+    that fits, or at the limit itself, but never inside the newline symbol.
+
+    Returns:
+        List of (start, end) offsets into text, with surrounding whitespace excluded
+    """
+    max_length = max(1, max_length)
+    segments = []
+
+    def emit(start, end):
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start < end:
+            segments.append((start, end))
+
+    def size(start, end):
+        return len(text[start:end].encode('utf-8')) if max_bytes else 0
+
+    if len(text) <= max_length and (not max_bytes or size(0, len(text)) <= max_bytes):
+        emit(0, len(text))
+        return segments
+
+    protected = [match.span() for match in re.finditer(re.escape(newline_symbol), text)]
+    protected_starts = [span[0] for span in protected]
+
+    def cut_point(start, end):
+        """Where to cut an overlong piece text[start:end] so that the first part fits"""
+        limit = min(end, start + max_length)
+        if max_bytes:
+            used = 0
+            for pos in range(start, limit):
+                used += len(text[pos].encode('utf-8'))
+                if used > max_bytes:
+                    limit = pos
+                    break
+        cut = text.rfind(' ', start + 1, limit) + 1 if limit < end else limit
+        if cut <= start:
+            cut = max(limit, start + 1)
+        # Move the cut out of any protected span it falls into
+        span = bisect.bisect_right(protected_starts, cut - 1) - 1
+        if span >= 0 and protected[span][0] < cut < protected[span][1]:
+            cut = protected[span][0] if protected[span][0] > start else protected[span][1]
+        return cut
+
+    start = 0       # start of the part being packed
+    packed = 0      # end of the whole sentences packed into it so far
+    chars = 0
+    used_bytes = 0
+    ends = [match.end() for match in boundary_pattern(newline_symbol).finditer(text)]
+    ends.append(len(text))
+    for end in ends:
+        if end <= packed:
+            continue
+        piece_chars = end - packed
+        piece_bytes = size(packed, end)
+        if chars + piece_chars <= max_length and (not max_bytes or used_bytes + piece_bytes <= max_bytes):
+            chars += piece_chars
+            used_bytes += piece_bytes
+            packed = end
+            continue
+
+        # The sentence does not fit: close the current part and start a new one with it
+        if packed > start:
+            emit(start, packed)
+            start = packed
+        if piece_chars <= max_length and (not max_bytes or piece_bytes <= max_bytes):
+            chars, used_bytes, packed = piece_chars, piece_bytes, end
+            continue
+
+        # A single sentence longer than the limit is cut into several parts
+        while True:
+            cut = cut_point(start, end)
+            if cut >= end:
+                break
+            emit(start, cut)
+            start = cut
+            if end - start <= max_length and (not max_bytes or size(start, end) <= max_bytes):
+                break
+        chars, used_bytes, packed = end - start, size(start, end), end
+
+    emit(start, packed)
+    return segments
+
+def get_translation_pool():
+    """Return the extension's long-lived worker pool, creating it on first use"""
+    global translation_pool
+    with translation_pool_lock:
+        if translation_pool is None:
+            translation_pool = concurrent.futures.ThreadPoolExecutor(max_workers=TRANSLATION_POOL_SIZE, thread_name_prefix="google_translate_plus")
+        return translation_pool
+
+def retry_delay(attempt):
+    """Jittered exponential backoff ("full jitter") before the next attempt"""
+    base = get_settings().get('retry_backoff', 0.5)
+    return random.uniform(0, min(RETRY_BACKOFF_CAP, base * 2 ** (attempt - 1)))
+
+class CircuitBreaker:
+    """
+    Per-engine circuit breaker. After circuit_breaker_failures consecutive failures the engine is
+    skipped for circuit_breaker_cooldown seconds, then a single trial request is let through.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.trial_at = 0.0
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            # A trial request that never reported back is given up after another cooldown
+            if time.monotonic() - (self.trial_at if self.trial else self.opened_at) < get_settings().get('circuit_breaker_cooldown', 60):
+                return False
+            self.trial = True  # half-open
+            self.trial_at = time.monotonic()
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= get_settings().get('circuit_breaker_failures', 3):
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if self.trial else "open"
+
+def get_circuit_breaker(engine):
+    with circuit_breakers_lock:
+        breaker = circuit_breakers.get(engine)
+        if breaker is None:
+            breaker = circuit_breakers[engine] = CircuitBreaker()
+        return breaker
+
+class EngineThrottle:
+    """
+    Client-side rate limiting and adaptive concurrency control for one engine, shared by all messages
+
+    Two token buckets enforce the engine's rate_limits (requests per second, characters per minute).
+    The concurrency cap follows AIMD between 1 and the engine's max_concurrency: it grows by 1/cap
+    per successful request and halves, at most once per second, when the engine throttles or a
+    request takes more than THROTTLE_LATENCY_GROWTH times the recent p10 latency of requests of
+    similar size (same power of two of characters). Requests that find the cap full wait in a FIFO
+    queue and are granted the slots as they are released, so no message waits much longer than
+    the others.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.request_tokens = None
+        self.char_tokens = None
+        self.updated = time.monotonic()
+        self.limit = float(self.max_limit())
+        self.in_flight = 0
+        self.queue = deque()  # futures of the requests waiting for a concurrency slot, oldest first
+        self.last_decrease = 0.0
+        self.latencies = {}  # request size class -> recent latencies
+
+    def max_limit(self):
+        limits = get_settings().get('rate_limits', {}).get(self.engine, {})
+        return max(1, int(limits.get('max_concurrency') or ENGINE_DEFAULT_CONCURRENCY))
+
+    def rates(self):
+        limits = get_settings().get('rate_limits', {}).get(self.engine, {})
+        return limits.get('requests_per_second', 0), limits.get('chars_per_minute', 0)
+
+    def acquire(self):
+        """
+        Ask for a concurrency slot. Slots are granted in the order they were asked for.
+
+        Returns:
+            Future that completes once the slot is granted; cancel it to stop waiting
+        """
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.queue.append(future)
+            self._grant()
+        return future
+
+    def try_acquire(self):
+        """Take a concurrency slot if one is free and nobody is waiting for one"""
+        with self.lock:
+            if self.queue or self.in_flight >= self.cap():
+                return False
+            self.in_flight += 1
+            return True
+
+    def take_tokens(self, chars):
+        """
+        Take the rate tokens for a request of chars characters
+
+        Returns:
+            0 if the request may be sent now, otherwise the number of seconds to wait before asking again
+        """
+        with self.lock:
+            requests_per_second, chars_per_minute = self.rates()
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.updated = now
+            if requests_per_second:
+                capacity = max(1.0, requests_per_second)
+                tokens = capacity if self.request_tokens is None else self.request_tokens
+                self.request_tokens = min(capacity, tokens + elapsed * requests_per_second)
+            if chars_per_minute:
+                tokens = chars_per_minute if self.char_tokens is None else self.char_tokens
+                self.char_tokens = min(chars_per_minute, tokens + elapsed * chars_per_minute / 60)
+                chars = min(chars, chars_per_minute)
+
+            wait = 0.0
+            if requests_per_second and self.request_tokens < 1:
+                wait = (1 - self.request_tokens) / requests_per_second
+            if chars_per_minute and self.char_tokens < chars:
+                wait = max(wait, (chars - self.char_tokens) * 60 / chars_per_minute)
+            if wait:
+                return wait
+
+            if requests_per_second:
+                self.request_tokens -= 1
+            if chars_per_minute:
+                self.char_tokens -= chars
+            return 0
+
+    def release(self, *_):
+        """Give back a concurrency slot; also a done callback of the request futures"""
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            self._grant()
+
+    def cap(self):
+        return int(min(self.limit, self.max_limit()))
+
+    def _grant(self):
+        while self.queue and self.in_flight < self.cap():
+            future = self.queue.popleft()
+            if future.set_running_or_notify_cancel():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def on_success(self, latency, chars):
+        with self.lock:
+            samples = self.latencies.setdefault(int(chars).bit_length(), deque(maxlen=THROTTLE_LATENCY_SAMPLES))
+            baseline = sorted(samples)[len(samples) // 10] if len(samples) >= THROTTLE_MIN_SAMPLES else None
+            samples.append(latency)
+            if baseline and latency > THROTTLE_LATENCY_GROWTH * baseline:
+                self._decrease()
+            else:
+                self.limit = min(float(self.max_limit()), self.limit + 1 / self.limit)
+                self._grant()
+
+    def on_throttle(self):
+        with self.lock:
+            self._decrease()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease >= 1:
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = now
+
+def get_engine_throttle(engine):
+    with circuit_breakers_lock:
+        throttle = engine_throttles.get(engine)
+        if throttle is None:
+            throttle = engine_throttles[engine] = EngineThrottle(engine)
+        return throttle
+
+def engine_chain(engine, settings=None):
+    """The selected engine followed by the configured fallback engines, without duplicates"""
+    if settings is None:
+        settings = get_settings()
+    chain = [engine]
+    for fallback in settings.get('fallback_engines', ()):
+        if fallback not in chain:
+            chain.append(fallback)
+    return chain
+
+def hedge_delay(engine, timeout):
+    """How long to wait for an engine before sending the same request to the next one"""
+    delay = translation_metrics.latency_percentile(engine, get_settings().get('hedge_percentile', 95))
+    if delay is None:
+        delay = min(HEDGE_DEFAULT_DELAY, timeout / 2)
+    return min(max(delay, HEDGE_MIN_DELAY), timeout * 0.8)
+
+def translate_with_timeout(fragments, sourcelang, targetlang, engine, timeout, deadline=None, settings=None):
+    """
+    Translate fragments concurrently on the shared worker pool, retrying failed or timed out fragments
+
+    Fragments are packed into batches for engines that accept several texts per request, and at
+    most max_concurrent_requests requests of a message are in flight at once. A batch that moves
+    to another engine is packed again for that engine's batch limits. Every attempt is
+    bounded by timeout and the whole call by deadline (a time.monotonic() value); calls that run
+    over are abandoned instead of waited for.
+
+    Failed and throttled batches move on to the next engine of engine_chain(engine), skipping
+    engines whose circuit breaker is open. With hedging enabled, a batch that takes longer than the engine's
+    usual latency is also sent to the next engine, if it fits in one request there, and the first
+    answer wins. While an engine's circuit breaker lets a trial request through, other batches
+    wait for its outcome instead of failing. Retries on the same
+    engine are spaced with jittered exponential backoff. Each engine's EngineThrottle decides when
+    a request may actually be sent.
+
+    Returns:
+        List of translated fragments in input order, or None if any fragment could not be translated
+    """
+    if settings is None:
+        settings = get_settings()
+    debug = settings.get('debug', False)
+    max_attempts = 3
+    concurrency = max(1, int(settings.get('max_concurrent_requests', 4)))
+    if deadline is None:
+        deadline = time.monotonic() + settings.get('message_timeout', 30)
+    pool = get_translation_pool()
+    chain = engine_chain(engine, settings)
+    hedging = settings.get('hedge_requests', True) and len(chain) > 1
+
+    batches = pack_batches(fragments, engine)
+    results = [None] * len(fragments)
+    attempts = [0] * len(batches)
+    failovers = [0] * len(batches)  # how far along the engine chain each batch has moved
+    hedged = [False] * len(batches)
+    throttled = [0] * len(batches)
+    running = [{} for _ in batches]  # engine -> future, for each batch
+    pending = deque(range(len(batches)))
+    waiting = []  # heap of (retry time, batch index) for batches backing off
+    in_flight = {}  # future -> (batch index, engine, start time, attempt deadline)
+    queued = {}  # concurrency slot future -> (batch index, engine) for batches waiting for a slot
+    reserved = {}  # batch index -> engine, for batches that hold a slot but wait for rate tokens
+
+    def pick_engine(idx):
+        for offset in range(len(chain)):
+            candidate = chain[(failovers[idx] + offset) % len(chain)]
+            if candidate not in running[idx] and get_circuit_breaker(candidate).allow():
+                return candidate
+        return None
+
+    def fit_batch(idx, candidate):
+        """Split a batch into the requests candidate accepts; the batch keeps the first one"""
+        indices = batches[idx]
+        parts = pack_batches([fragments[i] for i in indices], candidate)
+        batches[idx] = [indices[i] for i in parts[0]]
+        for part in parts[1:]:
+            batches.append([indices[i] for i in part])
+            attempts.append(attempts[idx])
+            failovers.append(failovers[idx])
+            hedged.append(False)
+            throttled.append(throttled[idx])
+            running.append({})
+            pending.append(len(batches) - 1)
+
+    def submit(idx, candidate, now):
+        """Send a batch to an engine whose concurrency slot it holds, or return how long its rate limiter wants us to wait"""
+        throttle = get_engine_throttle(candidate)
+        wait = throttle.take_tokens(sum(len(fragments[i]) for i in batches[idx]))
+        if wait:
+            return wait
+        future = pool.submit(perform_translation_batch, [fragments[i] for i in batches[idx]], sourcelang, targetlang, candidate, settings)
+        future.add_done_callback(throttle.release)
+        running[idx][candidate] = future
+        in_flight[future] = (idx, candidate, now, min(now + timeout, deadline))
+        return 0
+
+    def schedule_retry(idx):
+        failovers[idx] += 1
+        if len(chain) > 1:
+            # Fail over to the next engine straight away
+            pending.append(idx)
+            return True
+        retry_at = time.monotonic() + retry_delay(attempts[idx])
+        if retry_at >= deadline:
+            return False
+        heapq.heappush(waiting, (retry_at, idx))
+        return True
+
+    try:
+        while pending or waiting or in_flight or queued:
+            now = time.monotonic()
+            if now >= deadline:
+                if debug:
+                    print("[Google translate plus]: Translation ran out of the per-message time budget.")
+                gr.error("Translation took longer than the message time budget. Returning original text.")
+                return None
+
+            while waiting and waiting[0][0] <= now:
+                pending.append(heapq.heappop(waiting)[1])
+
+            for slot, (idx, candidate) in list(queued.items()):
+                if slot.done():
+                    del queued[slot]
+                    reserved[idx] = candidate
+                    pending.appendleft(idx)
+
+            for _ in range(len(pending)):
+                idx = pending.popleft()
+                candidate = reserved.pop(idx, None)
+                if candidate is None:
+                    if len(in_flight) + len(queued) + len(reserved) >= concurrency:
+                        pending.append(idx)
+                        continue
+                    candidate = pick_engine(idx)
+                    if candidate is None and any(get_circuit_breaker(name).state == "half-open" for name in chain):
+                        # A recovering engine is busy with its trial request: wait for the outcome
+                        heapq.heappush(waiting, (now + CIRCUIT_TRIAL_POLL_INTERVAL, idx))
+                        continue
+                    if candidate is None:
+                        if debug:
+                            print("[Google translate plus]: All translation engines are unavailable (circuit open).")
+                        gr.error("All translation engines are currently unavailable. Returning original text.")
+                        return None
+                    fit_batch(idx, candidate)
+                    slot = get_engine_throttle(candidate).acquire()
+                    if not slot.done():
+                        # The engine's concurrency cap is full: wait for a slot in line with other messages
+                        queued[slot] = (idx, candidate)
+                        continue
+                wait = submit(idx, candidate, now)
+                if wait:
+                    # Rate limited on the client side: keep the slot and try again once tokens are available
+                    reserved[idx] = candidate
+                    heapq.heappush(waiting, (now + wait, idx))
+                    continue
+                attempts[idx] += 1
+
+            wake_at = deadline
+            if hedging:
+                # Hedge batches whose only request is slower than usual
+                for future, (idx, used, started, _) in list(in_flight.items()):
+                    if hedged[idx] or len(running[idx]) > 1:
+                        continue
+                    hedge_at = started + hedge_delay(used, timeout)
+                    if hedge_at > now:
+                        wake_at = min(wake_at, hedge_at)
+                    elif len(in_flight) < concurrency:
+                        candidate = pick_engine(idx)
+                        if candidate is None or len(pack_batches([fragments[i] for i in batches[idx]], candidate)) > 1:
+                            continue
+                        if not get_engine_throttle(candidate).try_acquire():
+                            continue
+                        if submit(idx, candidate, now):
+                            get_engine_throttle(candidate).release()
+                        else:
+                            hedged[idx] = True
+                            translation_metrics.count(candidate, "hedges")
+                            if debug:
+                                print(f"[Google translate plus]: {used.capitalize()} is slow, hedging with {candidate.capitalize()}...")
+            if in_flight:
+                wake_at = min(wake_at, min(attempt_deadline for _, _, _, attempt_deadline in in_flight.values()))
+            if waiting:
+                wake_at = min(wake_at, waiting[0][0])
+            if in_flight or queued:
+                done, _ = concurrent.futures.wait([*in_flight, *queued], timeout=max(0, wake_at - time.monotonic()), return_when=concurrent.futures.FIRST_COMPLETED)
+            else:
+                done = set()
+                time.sleep(max(0, wake_at - time.monotonic()))
+            now = time.monotonic()
+
+            for future, (idx, used, started, attempt_deadline) in list(in_flight.items()):
+                if future not in in_flight:
+                    continue  # cancelled because another engine already answered
+                attempt = attempts[idx]
+                if future in done:
+                    del in_flight[future]
+                    running[idx].pop(used, None)
+                    try:
+                        translated_str = future.result()
+                    except TranslationThrottled:
+                        # The engine is healthy but busy: fail over to the next engine, or back off once
+                        # every engine of the chain has throttled, without tripping the circuit breaker
+                        # or using up an attempt
+                        attempts[idx] -= 1
+                        throttled[idx] += 1
+                        if running[idx]:
+                            continue
+                        failovers[idx] += 1
+                        if throttled[idx] % len(chain):
+                            pending.append(idx)
+                            continue
+                        retry_at = now + retry_delay(throttled[idx] // len(chain))
+                        if retry_at < deadline:
+                            heapq.heappush(waiting, (retry_at, idx))
+                            continue
+                        if debug:
+                            print("[Google translate plus]: Translation ran out of the per-message time budget.")
+                        gr.error("Translation took longer than the message time budget. Returning original text.")
+                        return None
+                    except Exception as e:
+                        if debug:
+                            print(f"[Google translate plus]: An error occurred during translation (attempt {attempt}): {e}")
+                        if running[idx]:
+                            continue  # the hedged request may still succeed
+                        if attempt < max_attempts and schedule_retry(idx):
+                            translation_metrics.count(used, "retries")
+                            gr.warning(f"Translation error (attempt {attempt}): {e}. Retrying...")
+                            continue
+                        gr.error(f"Translation failed after all attempts: {e}")
+                        return None
+                    if translated_str is not None:
+                        for fragment_idx, translated_fragment in zip(batches[idx], translated_str):
+                            results[fragment_idx] = translated_fragment
+                        # The first answer wins; drop the other engine's request
+                        for other in running[idx].values():
+                            other.cancel()
+                            in_flight.pop(other, None)
+                        running[idx].clear()
+                        continue
+                    if running[idx]:
+                        continue
+                    if attempt < max_attempts and schedule_retry(idx):
+                        translation_metrics.count(used, "retries")
+                        if debug:
+                            print(f"[Google translate plus]: Translation attempt {attempt} failed. Retrying...")
+                        continue
+                    if debug:
+                        print("[Google translate plus]: All translation attempts failed.")
+                    return None
+                elif now >= attempt_deadline:
+                    # The worker is abandoned rather than waited for
+                    del in_flight[future]
+                    running[idx].pop(used, None)
+                    future.cancel()
+                    get_circuit_breaker(used).failure()
+                    translation_metrics.count(used, "timeouts")
+                    if running[idx]:
+                        continue
+                    if attempt < max_attempts and schedule_retry(idx):
+                        translation_metrics.count(used, "retries")
+                        if debug:
+                            print(f"[Google translate plus]: Translation timed out (attempt {attempt}). Retrying...")
+                        gr.warning(f"Translation timed out (attempt {attempt}). Retrying...")
+                        continue
+                    if attempt < max_attempts:
+                        if debug:
+                            print("[Google translate plus]: Translation ran out of the per-message time budget.")
+                        gr.error("Translation took longer than the message time budget. Returning original text.")
+                        return None
+                    if debug:
+                        print("[Google translate plus]: Translation timed out after all attempts. Returning original text.")
+                    gr.error("Translation timed out after all attempts. Returning original text.")
+                    return None
+    finally:
+        for future in in_flight:
+            future.cancel()
+        for slot, (_, candidate) in queued.items():
+            if not slot.cancel():
+                get_engine_throttle(candidate).release()  # granted but never used
+        for candidate in reserved.values():
+            get_engine_throttle(candidate).release()
+
+    return results
+
+class TranslationBackend:
+    """
+    Base class of translation engines
+
+    Subclasses implement translate() and, if the engine accepts several texts per request,
+    translate_batch() together with batch_limits. supported_languages() and warmup() are optional.
+    Every method receives the settings snapshot of the message being translated.
+    """
+    label = None  # name in the UI; engines without one can only be selected programmatically
+    max_request = None  # {'size', 'unit'} limit of a single request, unit 'chars' or 'bytes'
+    batch_limits = None  # {'texts', 'size', 'unit'} limits of a translate_batch() call
+
+    def translate(self, text, sourcelang, targetlang, settings):
+        raise NotImplementedError
+
+    def translate_batch(self, texts, sourcelang, targetlang, settings):
+        return [self.translate(text, sourcelang, targetlang, settings) for text in texts]
+
+    def supported_languages(self, settings):
+        """Language codes the engine supports, or None if unknown"""
+        return None
+
+    def capabilities(self, settings, fetch_languages=True):
+        """Capability metadata, see get_engine_info(); without fetch_languages the supported languages are unknown"""
+        languages = None
+        if fetch_languages:
+            try:
+                languages = self.supported_languages(settings)
+            except Exception as e:
+                if settings.get('debug', False):
+                    print(f"[Google translate plus]: Could not get the supported languages: {e}")
+        max_request_chars = None
+        if self.max_request is not None:
+            # A character can take up to four bytes in UTF-8
+            max_request_chars = self.max_request['size'] // 4 if self.max_request['unit'] == 'bytes' else self.max_request['size']
+        return {
+            'supported_languages': frozenset(code.lower() for code in languages) or None if languages else None,
+            'rtl_languages': RTL_LANGUAGES,
+            'max_request': self.max_request,
+            'max_request_chars': max_request_chars,
+            'batch': self.batch_limits is not None,
+            'batch_limits': self.batch_limits,
+        }
+
+    def warmup(self, settings):
+        """Prepare connections or models ahead of the first translation"""
+
+    def cache_context(self, settings):
+        """Settings that change the engine's translations, made part of the cache keys"""
+        return ()
+
+class DeepTranslatorBackend(TranslationBackend):
+    """Engines used through deep_translator clients"""
+    def create_client(self, sourcelang, targetlang, settings):
+        raise NotImplementedError
+
+    def client_options(self, settings):
+        """Settings the client is created with"""
+        return ()
+
+    def client(self, sourcelang, targetlang, settings):
+        """
+        Return a reusable deep_translator client for the current worker thread
+
+        deep_translator clients keep per-request state on the instance, so they are cached per thread
+        rather than shared between the pool's workers.
+        """
+        clients = getattr(translator_clients, 'clients', None)
+        if clients is None:
+            clients = translator_clients.clients = {}
+        key = (type(self).__name__, sourcelang, targetlang) + self.client_options(settings)
+        translator = clients.get(key)
+        if translator is None:
+            translator = clients[key] = self.create_client(sourcelang, targetlang, settings)
+        return translator
+
+    def translate(self, text, sourcelang, targetlang, settings):
+        return self.client(sourcelang, targetlang, settings).translate(text)
+
+class GoogleBackend(DeepTranslatorBackend):
+    label = 'Google Translate'
+    max_request = {'size': 5000, 'unit': 'chars'}
+
+    def create_client(self, sourcelang, targetlang, settings):
+        from deep_translator import GoogleTranslator
+        return GoogleTranslator(source=sourcelang, target=targetlang)
+
+    def supported_languages(self, settings):
+        from deep_translator import GoogleTranslator
+        return GoogleTranslator().get_supported_languages(as_dict=True).values()
+
+    def warmup(self, settings):
+        # deep_translator sends every Google request on a new connection, so loading the module
+        # (deferred at startup) is all there is to prepare
+        importlib.import_module("deep_translator")
+
+class DeeplBackend(DeepTranslatorBackend):
+    """DeepL; batches go to the REST API in a single request over the shared HTTP session"""
+    label = 'Deepl Translator'
+    max_request = {'size': 120 * 1024, 'unit': 'bytes'}
+    batch_limits = {'texts': 50, 'size': 120 * 1024, 'unit': 'bytes'}
+
+    def client_options(self, settings):
+        return (settings.get('DeeplAPIkey', ""), settings.get('DeeplFreeAPI', True))
+
+    def create_client(self, sourcelang, targetlang, settings):
+        from deep_translator import DeeplTranslator
+        api_key, use_free_api = self.client_options(settings)
+        return DeeplTranslator(source=sourcelang, target=targetlang, api_key=api_key, use_free_api=use_free_api)
+
+    @staticmethod
+    def api_url(settings, endpoint):
+        return ("https://api-free.deepl.com/v2/" if settings.get('DeeplFreeAPI', True) else "https://api.deepl.com/v2/") + endpoint
+
+    def translate_batch(self, texts, sourcelang, targetlang, settings):
+        url = self.api_url(settings, "translate")
+        data = [("text", text) for text in texts]
+        data.append(("target_lang", deepl_language(targetlang, target=True)))
+        if sourcelang and sourcelang != 'auto':
+            data.append(("source_lang", deepl_language(sourcelang)))
+        response = get_http_session().post(url, data=data, headers={"Authorization": f"DeepL-Auth-Key {settings.get('DeeplAPIkey', '')}"},
+                                           timeout=settings.get('translation_timeout', 10))
+        raise_for_status(response, "DeepL")
+        return [item["text"] for item in response.json()["translations"]]
+
+    def supported_languages(self, settings):
+        from deep_translator import DeeplTranslator
+        return DeeplTranslator(api_key=settings.get('DeeplAPIkey', "") or "-").get_supported_languages(as_dict=True).values()
+
+    def warmup(self, settings):
+        if settings.get('DeeplAPIkey', ""):
+            # Open the keep-alive connection that batch requests reuse
+            get_http_session().get(self.api_url(settings, "usage"), headers={"Authorization": f"DeepL-Auth-Key {settings.get('DeeplAPIkey', '')}"}, timeout=5)
+
+class LibreBackend(TranslationBackend):
+    """LibreTranslate, called directly over the shared HTTP session; batches are sent as one request"""
+    label = 'LibreTranslate (local)'
+    max_request = {'size': 10000, 'unit': 'chars'}
+    batch_limits = {'texts': 32, 'size': 10000, 'unit': 'chars'}
+
+    def translate(self, text, sourcelang, targetlang, settings):
+        return self.request(text, sourcelang, targetlang, settings)
+
+    def translate_batch(self, texts, sourcelang, targetlang, settings):
+        return self.request(list(texts), sourcelang, targetlang, settings)
+
+    @staticmethod
+    def request(q, sourcelang, targetlang, settings):
+        payload = {"q": q, "source": libre_language(sourcelang), "target": libre_language(targetlang), "format": "text"}
+        if settings.get('LibreTranslateAPIkey', ""):
+            payload["api_key"] = settings.get('LibreTranslateAPIkey', "")
+        url = settings.get('LibreTranslateAPI', "http://localhost:5000/").rstrip('/') + "/translate"
+        response = get_http_session().post(url, json=payload, timeout=settings.get('translation_timeout', 10))
+        raise_for_status(response, "LibreTranslate")
+        return response.json()["translatedText"]
+
+    def cache_context(self, settings):
+        return (settings.get('LibreTranslateAPI', "http://localhost:5000/"),)
+
+    def supported_languages(self, settings):
+        response = get_http_session().get(settings.get('LibreTranslateAPI', "http://localhost:5000/").rstrip('/') + "/languages", timeout=3)
+        response.raise_for_status()
+        return [language["code"] for language in response.json()]
+
+    def warmup(self, settings):
+        get_http_session()
+
+class LocalModelBackend(TranslationBackend):
+    """
+    In-process translation with a local sequence-to-sequence model (MarianMT by default), so that
+    no request leaves the machine
+
+    local_model names the model of a language pair, as a Hugging Face model name or a local path
+    with {source} and {target} placeholders. Models are loaded on first use (or by warmup()) and
+    kept for the most recent LOCAL_MODEL_MAX_LOADED language pairs. Requests from concurrent
+    messages are queued; a worker waits up to LOCAL_MODEL_BATCH_WAIT seconds for more texts for
+    the same model and translates them together in one batch.
+    """
+    label = 'Local model (MarianMT)'
+    max_request = {'size': 1000, 'unit': 'chars'}  # the models take up to 512 tokens
+    batch_limits = {'texts': 16, 'size': 8000, 'unit': 'chars'}
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = deque()  # (model name, texts, settings, future)
+        self.workers = []
+        self.models = OrderedDict()  # model name -> (tokenizer, model), least recently used first
+        self.models_lock = threading.Lock()
+
+    @staticmethod
+    def model_name(sourcelang, targetlang, settings):
+        template = settings.get('local_model', "Helsinki-NLP/opus-mt-{source}-{target}")
+        return template.format(source=base_language(sourcelang), target=base_language(targetlang))
+
+    def translate(self, text, sourcelang, targetlang, settings):
+        return self.translate_batch([text], sourcelang, targetlang, settings)[0]
+
+    def cache_context(self, settings):
+        return (settings.get('local_model', "Helsinki-NLP/opus-mt-{source}-{target}"),)
+
+    def translate_batch(self, texts, sourcelang, targetlang, settings):
+        future = concurrent.futures.Future()
+        with self.condition:
+            self.pending.append((self.model_name(sourcelang, targetlang, settings), list(texts), settings, future))
+            self.start_workers(settings)
+            self.condition.notify()
+        return future.result()
+
+    def start_workers(self, settings):
+        self.workers = [worker for worker in self.workers if worker.is_alive()]
+        while len(self.workers) < max(1, int(settings.get('local_model_workers', 1))):
+            worker = threading.Thread(target=self.run, name="google_translate_plus_local_model", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def queued_texts(self, model_name):
+        return sum(len(texts) for name, texts, _, _ in self.pending if name == model_name)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                model_name, _, settings, _ = self.pending[0]
+                batch_size = max(1, int(settings.get('local_model_batch_size', 16)))
+                # Give concurrent requests a moment to join the batch
+                deadline = time.monotonic() + LOCAL_MODEL_BATCH_WAIT
+                while self.queued_texts(model_name) < batch_size and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                batch = []
+                rest = deque()
+                size = 0
+                for request in self.pending:
+                    if request[0] == model_name and (not batch or size + len(request[1]) <= batch_size):
+                        batch.append(request)
+                        size += len(request[1])
+                    else:
+                        rest.append(request)
+                self.pending = rest
+
+            try:
+                translated = self.generate(model_name, [text for _, texts, _, _ in batch for text in texts], settings)
+            except Exception as e:
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            position = 0
+            for _, texts, _, future in batch:
+                future.set_result(translated[position:position + len(texts)])
+                position += len(texts)
+
+    def load(self, model_name, settings):
+        with self.models_lock:
+            if model_name in self.models:
+                self.models.move_to_end(model_name)
+                return self.models[model_name]
+            try:
+                # torch is imported by generate(); only check here that it is installed
+                if importlib.util.find_spec("torch") is None:
+                    raise ImportError("No module named 'torch'")
+                from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+            except ImportError as e:
+                raise RuntimeError("the local model needs the transformers, sentencepiece and torch packages") from e
+            print(f"[Google translate plus]: Loading the local translation model {model_name}...")
+            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            model = AutoModelForSeq2SeqLM.from_pretrained(model_name).to(settings.get('local_model_device', 'cpu'))
+            model.eval()
+            self.models[model_name] = (tokenizer, model)
+            while len(self.models) > LOCAL_MODEL_MAX_LOADED:
+                self.models.popitem(last=False)
+            return tokenizer, model
+
+    def generate(self, model_name, texts, settings):
+        tokenizer, model = self.load(model_name, settings)
+        import torch
+        with torch.inference_mode():
+            inputs = tokenizer(texts, return_tensors="pt", padding=True, truncation=True).to(model.device)
+            outputs = model.generate(**inputs, max_new_tokens=LOCAL_MODEL_MAX_TOKENS)
+        return tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    def warmup(self, settings):
+        """Load the models of both directions of the selected language pair"""
+        language = settings.get('language string', 'ru')
+        for sourcelang, targetlang in ((language, "en"), ("en", language)):
+            self.load(self.model_name(sourcelang, targetlang, settings), settings)
+
+class ClientBackend(TranslationBackend):
+    """
+    Engine given as a plain object with translate(text, sourcelang, targetlang) and, if it has
+    batch limits, translate_batch(texts, sourcelang, targetlang), e.g. the mock engine of benchmark.py
+    """
+    def __init__(self, client, max_request=None, batch_limits=None):
+        self.client = client
+        self.max_request = max_request
+        self.batch_limits = batch_limits
+
+    def translate(self, text, sourcelang, targetlang, settings):
+        return self.client.translate(text, sourcelang, targetlang)
+
+    def translate_batch(self, texts, sourcelang, targetlang, settings):
+        return self.client.translate_batch(texts, sourcelang, targetlang)
+
+    def supported_languages(self, settings):
+        return getattr(self.client, 'supported_languages', None)
+
+def register_engine(name, backend, max_request=None, batch_limits=None, label=None):
+    """
+    Register a translation engine under name
+
+    backend is a TranslationBackend, or any object with translate(text, sourcelang, targetlang)
+    (and translate_batch(texts, sourcelang, targetlang) if batch_limits are given), which is
+    wrapped in a ClientBackend. Engines with a label are offered in the UI.
+    """
+    if not isinstance(backend, TranslationBackend):
+        backend = ClientBackend(backend, max_request, batch_limits)
+    engine_registry[name] = backend
+    label = label or backend.label
+    if label:
+        engines[label] = name
+    engine_info.pop(name, None)
+
+def unregister_engine(name):
+    engine_registry.pop(name, None)
+    for label in [label for label, engine in engines.items() if engine == name]:
+        del engines[label]
+    engine_info.pop(name, None)
+
+register_engine('deepl', DeeplBackend())
+register_engine('google', GoogleBackend())
+register_engine('libre', LibreBackend())
+register_engine('local', LocalModelBackend())
+
+def warmup_engine(engine):
+    """
+    Fetch an engine's capability metadata and warm it up on a background thread
+
+    Returns:
+        The warmup thread
+    """
+    def run():
+        try:
+            update_engine_info(engine)
+            backend = engine_registry.get(engine)
+            if backend is not None:
+                backend.warmup(get_settings())
+        except Exception as e:
+            print(f"[Google translate plus]: Warning: could not warm up {engine}: {e}")
+
+    thread = threading.Thread(target=run, name="google_translate_plus_warmup", daemon=True)
+    thread.start()
+    return thread
+
+def get_engine_info(engine):
+    """
+    Return the capability metadata of an engine from the TTL-bound index
+
+    The returned dict holds 'supported_languages' (frozenset of codes, or None when unknown),
+    'rtl_languages', 'max_request' ({'size', 'unit'} or None), 'max_request_chars', 'batch' and
+    'batch_limits'.
+
+    Never waits for the engine: an expired entry is served while a background thread rebuilds it,
+    and an engine without an entry gets its static limits, with unknown supported languages,
+    until the first rebuild has finished.
+    """
+    entry = engine_info.get(engine)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    if entry is None:
+        entry = engine_info.setdefault(engine, (0, build_engine_info(engine, fetch_languages=False)))
+    with engine_info_lock:
+        lock = engine_info_locks.setdefault(engine, threading.Lock())
+    if not lock.locked():
+        threading.Thread(target=update_engine_info, args=(engine, False), name="google_translate_plus_engine_info", daemon=True).start()
+    return entry[1]
+
+def update_engine_info(engine, blocking=True):
+    """
+    Rebuild an engine's capability metadata
+
+    Returns:
+        False if blocking is False and another rebuild of the engine is already running
+    """
+    with engine_info_lock:
+        lock = engine_info_locks.setdefault(engine, threading.Lock())
+    if not lock.acquire(blocking=blocking):
+        return False
+    try:
+        info = build_engine_info(engine)
+        ttl = ENGINE_INFO_TTL if info['supported_languages'] is not None else ENGINE_INFO_RETRY_TTL
+        engine_info[engine] = (time.monotonic() + ttl, info)
+    except Exception as e:
+        print(f"[Google translate plus]: Warning: could not get the capabilities of {engine}: {e}")
+    finally:
+        lock.release()
+    return True
+
+def build_engine_info(engine, fetch_languages=True):
+    backend = engine_registry.get(engine) or TranslationBackend()
+    return backend.capabilities(get_settings(), fetch_languages)
+
+def is_language_supported(engine, code):
+    """Check a language code against the engine's supported languages; unknown support counts as supported"""
+    supported = get_engine_info(engine)['supported_languages']
+    if supported is None:
+        return True
+    code = code.lower()
+    aliases = {'iw': 'he', 'he': 'iw', 'jw': 'jv', 'jv': 'jw', 'zh-tw': 'zt'}
+    return code in supported or code.split('-')[0] in supported or aliases.get(code) in supported
+
+def perform_translation(fragment, sourcelang, targetlang, engine, settings):
+    """
+    Perform the actual translation using the selected engine
+    
+    Args:
+        fragment: Text fragment to translate
+        sourcelang: Source language code
+        targetlang: Target language code
+        engine: Translation engine to use
+        settings: Settings snapshot of the message
+        
+    Returns:
+        Translated text or None if translation fails
+    """
+    fragment_unescaped = html.unescape(fragment)
+    
+    try:
+        return str(engine_registry[engine].translate(fragment_unescaped, sourcelang, targetlang, settings))
+    except Exception as e:
+        if is_throttling_error(e):
+            raise TranslationThrottled(str(e)) from e
+        print(f"[Google translate plus]: Translation error: {e}")
+        return None
+
+def pack_batches(fragments, engine):
+    """
+    Group fragment indices into as few requests as the engine's batch limits allow, keeping their order
+    """
+    limits = get_engine_info(engine)['batch_limits']
+    if limits is None:
+        return [[idx] for idx in range(len(fragments))]
+
+    batches = []
+    batch = []
+    batch_size = 0
+    for idx, fragment in enumerate(fragments):
+        size = len(fragment.encode('utf-8')) if limits['unit'] == 'bytes' else len(fragment)
+        if batch and (len(batch) >= limits['texts'] or batch_size + size > limits['size']):
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append(idx)
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+def get_http_session():
+    """Return the shared keep-alive HTTP session used for batch requests"""
+    global http_session
+    with translation_pool_lock:
+        if http_session is None:
+            import requests
+            http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=TRANSLATION_POOL_SIZE)
+            http_session.mount("http://", adapter)
+            http_session.mount("https://", adapter)
+        return http_session
+
+def raise_for_status(response, service):
+    """Raise TranslationThrottled for rate limiting responses and HTTPError for other failures"""
+    if response.status_code in THROTTLE_STATUS_CODES:
+        raise TranslationThrottled(f"{service} answered with HTTP {response.status_code}")
+    response.raise_for_status()
+
+def deepl_language(code, target=False):
+    code = {'iw': 'he', 'jw': 'jv'}.get(code, code)
+    if code.lower().startswith('zh'):
+        return 'ZH'
+    return code.upper() if target else code.split('-')[0].upper()
+
+def libre_language(code):
+    code = {'iw': 'he', 'jw': 'jv', 'zh-TW': 'zt'}.get(code, code)
+    return code.split('-')[0]
+
+def perform_translation_batch(fragments, sourcelang, targetlang, engine, settings):
+    """
+    Translate a batch of fragments, recording request, character, latency and failure metrics,
+    feeding throttling responses and latency back to the engine's EngineThrottle and the outcome to
+    its circuit breaker
+
+    The outcome is recorded here, in the worker, so that it counts even when the message that sent
+    the request has stopped waiting for it.
+    """
+    requests_sent = 1 if len(fragments) == 1 or get_engine_info(engine)['batch'] else len(fragments)
+    translation_metrics.count(engine, "requests", requests_sent)
+    translation_metrics.count(engine, "chars", sum(len(fragment) for fragment in fragments))
+    start = time.perf_counter()
+    try:
+        translated = _perform_translation_batch(fragments, sourcelang, targetlang, engine, settings)
+    except TranslationThrottled as e:
+        if get_settings().get('debug', False):
+            print(f"[Google translate plus]: {engine.capitalize()} is throttling requests: {e}")
+        get_engine_throttle(engine).on_throttle()
+        translation_metrics.count(engine, "throttled")
+        raise
+    except Exception:
+        get_circuit_breaker(engine).failure()
+        raise
+    elapsed = time.perf_counter() - start
+    translation_metrics.record_stage("engine request", elapsed)
+    translation_metrics.record_request(engine, elapsed / requests_sent)
+    if translated is None:
+        translation_metrics.count(engine, "failures")
+        get_circuit_breaker(engine).failure()
+    else:
+        get_circuit_breaker(engine).success()
+        get_engine_throttle(engine).on_success(elapsed / requests_sent, sum(len(fragment) for fragment in fragments) / requests_sent)
+    return translated
+
+def _perform_translation_batch(fragments, sourcelang, targetlang, engine, settings):
+    """
+    Translate several fragments with as few requests as possible
+
+    Engines with batch limits get the whole batch in a single translate_batch call; other engines
+    translate the fragments one by one. Unknown engines leave the fragments untranslated.
+
+    Returns:
+        List of translated fragments or None if translation fails
+    """
+    backend = engine_registry.get(engine)
+    if backend is None:
+        return list(fragments)  # No translation
+    if len(fragments) == 1 or backend.batch_limits is None:
+        translated = [perform_translation(fragment, sourcelang, targetlang, engine, settings) for fragment in fragments]
+        return None if None in translated else translated
+
+    texts = [html.unescape(fragment) for fragment in fragments]
+    try:
+        translated = backend.translate_batch(texts, sourcelang, targetlang, settings)
+        if len(translated) != len(fragments):
+            raise ValueError(f"expected {len(fragments)} translations, got {len(translated)}")
+        return [str(text) for text in translated]
+    except Exception as e:
+        if is_throttling_error(e):
+            raise TranslationThrottled(str(e)) from e
+        print(f"[Google translate plus]: Batch translation error: {e}")
+        return None
+
+def bot_prefix_modifier(string):
+    return string
+
+class SettingsWriter:
+    """
+    Persists params in the background. Changes are debounced: settings.json is written once no
+    setting has changed for SETTINGS_SAVE_DELAY seconds, so typing in a textbox does not rewrite
+    the file on every keystroke.
+    """
+    def __init__(self, delay=SETTINGS_SAVE_DELAY):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.timer = None
+        self.mtime = None  # modification time of the last version we wrote or loaded, set by setup()
+
+    @staticmethod
+    def file_mtime():
+        try:
+            return os.stat(settings_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def schedule(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Write pending changes now"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            try:
+                write_settings(dict(params))
+                self.mtime = self.file_mtime()
+            except (OSError, TypeError, ValueError) as e:
+                print(f"[Google translate plus]: Warning: could not save settings: {e}")
+
+    def flush_pending(self):
+        """Write pending changes, if any (at exit)"""
+        if self.timer is not None:
+            self.flush()
+
+    def reload_if_changed(self):
+        """Load settings.json again if it was edited outside the extension"""
+        with self.lock:
+            mtime = self.file_mtime()
+            if mtime is None or mtime == self.mtime or self.timer is not None:
+                return False
+            try:
+                settings = load_settings()
+            except (OSError, json.JSONDecodeError):
+                return False  # e.g. still being written; try again on the next poll
+            self.mtime = mtime
+        if settings.get('LibreTranslateAPI') != params.get('LibreTranslateAPI'):
+            engine_info.pop('libre', None)
+        params.update(settings)
+        configure_cache()
+        translation_service.update_settings()
+        start_metrics_exporter()
+        print("[Google translate plus]: settings.json changed on disk, settings reloaded.")
+        return True
+
+settings_writer = SettingsWriter()
+atexit.register(settings_writer.flush_pending)
+settings_watcher = None
+
+def start_settings_watcher():
+    """Start the background thread that reloads settings.json when it is edited externally"""
+    global settings_watcher
+    if settings_watcher is not None and settings_watcher.is_alive():
+        return
+
+    def run():
+        while True:
+            time.sleep(SETTINGS_POLL_INTERVAL)
+            settings_writer.reload_if_changed()
+
+    settings_watcher = threading.Thread(target=run, name="google_translate_plus_settings", daemon=True)
+    settings_watcher.start()
+
+setup_done = False
+
+def setup(warmup=None):
+    """
+    Load settings.json and start the background work. The webui calls this once after importing
+    the extension; tools that import the script directly call it themselves.
+
+    Args:
+        warmup: Whether to warm up the selected engine in the background, default warmup_on_startup
+    """
+    global setup_done
+    if setup_done:
+        return
+    setup_done = True
+
+    # Keep the values the webui applied from its own settings between import and setup
+    overrides = {key: value for key, value in params.items() if default_params.get(key) != value}
+    try:
+        if os.path.exists(settings_path):
+            params.update(load_settings())
+        else:
+            write_settings(params)
+    except json.JSONDecodeError:
+        print("[Google translate plus]: Warning: settings.json has an invalid structure. Using default settings.")
+    except OSError as e:
+        print(f"[Google translate plus]: Warning: could not load settings: {e}")
+    params.update(overrides)
+    settings_writer.mtime = settings_writer.file_mtime()
+
+    configure_cache()
+    translation_service.update_settings()
+    start_metrics_exporter()
+    start_settings_watcher()
+    if params.get('warmup_on_startup', True) if warmup is None else warmup:
+        warmup_engine(params.get('engine', 'google'))
+
+def save_params():
+    """Publish the changed settings to translations at once and persist them shortly after"""
+    translation_service.update_settings()
+    settings_writer.schedule()
+
+def rate_limit(engine, key, default=0):
+    return params.get('rate_limits', {}).get(engine, {}).get(key) or default
+
+def update_rate_limit(key, value):
+    """Set a rate limit of the selected engine"""
+    params.setdefault('rate_limits', {}).setdefault(params.get('engine', 'google'), {})[key] = value
+    save_params()
+
+def language_choices(engine):
+    """Language dropdown entries supported by the engine, always keeping the selected language"""
+    current = params.get('language string', 'ru')
+    return [k for k, v in language_codes.items() if v == current or is_language_supported(engine, v)]
+
+def ui():
+    # Finding the language name from the language code to use as the default value
+    language_name = language_names.get(params.get('language string', 'ru'), 'English')
+    engine_name = next((k for k, v in engines.items() if v == params.get('engine', 'google')), 'Google Translate')
+
+    # Gradio elements
+    with gr.Accordion("Google Translate Plus", open=False):
+        with gr.Column():
+            Translate_user_input = gr.Checkbox(value=params.get('Translate_user_input', True), label='Translate user input')
+            Translate_system_output = gr.Checkbox(value=params.get('Translate_system_output', True), label='Translate system output')
+            enable_input_caching = gr.Checkbox(value=params.get('enable_input_caching', True), label='Enable input caching',
+                info='If enabled, input texts that were already translated will use the cached translation instead of re-translating.')
+            enable_output_caching = gr.Checkbox(value=params.get('enable_output_caching', True), label='Enable output caching',
+                info='If enabled, output texts that were already translated will use the cached translation instead of re-translating.')
+            stream_output_translation = gr.Checkbox(value=params.get('stream_output_translation', False), label='Translate streamed output incrementally',
+                info='Translates each sentence of a streamed reply once, as soon as it is completed, instead of re-translating the whole reply. The unfinished sentence is translated with every update.')
+            disable_split = gr.Checkbox(value=params.get('disable_split', False), label='Disable split',
+                info='Disables splitting long text into paragraphs. May improve translation quality, but Google Translate may give an error due to too long text. This will also disable the special symbol.')
+            disable_newline_replacement = gr.Checkbox(value=params.get('disable_newline_replacement', False), label='Disable newline replacement',
+                info='Disables the replacement of a newline by a special character. Recommended when using LibreTranslate.')
+            preserve_formatting = gr.Checkbox(value=params.get('preserve_formatting', True), label='Preserve formatting',
+                info='Attempts to preserve text formatting like bold, italic, and links during translation.')
+            rtl_support = gr.Checkbox(value=params.get('rtl_support', True), label='RTL language support',
+                info='Adds special markers for right-to-left languages like Arabic, Hebrew, Persian, etc.')
+            skip_same_language = gr.Checkbox(value=params.get('skip_same_language', True), label='Skip text already in the target language',
+                info='Detects the language locally and leaves text that is already in the target language, or has nothing to translate (e.g. only code), as it is.')
+            with gr.Accordion("Advanced", open=False):
+                language = gr.Dropdown(value=language_name, choices=language_choices(params.get('engine', 'google')), label='Language')
+                engine = gr.Dropdown(value=engine_name, choices=[k for k in engines], label='Translation service')
+                fallback_engines = gr.Dropdown(value=[k for k, v in engines.items() if v in params.get('fallback_engines', [])], choices=[k for k in engines],
+                    multiselect=True, label='Fallback translation services',
+                    info='Tried in order when the translation service fails or its circuit breaker is open.')
+                hedge_requests = gr.Checkbox(value=params.get('hedge_requests', True), label='Hedge slow requests',
+                    info='If the translation service is slower than usual, the same request is also sent to the first fallback service and the first answer is used.')
+                special_symbol = gr.Textbox(value=params.get('special_symbol', '~'), label='Special symbol.',
+                    info='Text between two such syblols on the same line will not be translated. May cause inaccurate translations, and some symbols other than the standard ~ may cause errors.', type='text',
+                    )
+                glossary = gr.Textbox(value="\n".join(params.get('glossary', [])), label='Do not translate',
+                    info='Names and terms that are never translated, one per line. They are matched case-sensitively as whole words.',
+                    lines=3)
+                newline_symbol = gr.Textbox(value=params.get('newline_symbol', '@'), label='Newline symbol',
+                    info='Before translation, this symbol replaces the new line, and after translation it is removed. Needed to save strings after translation. Some symbols may cause errors.',
+                    type='text',)
+                max_length = gr.Number(value=params.get('max_length', 1500), label='Maximum text length',
+                    info='If the text length exceeds this value, it will be divided into paragraphs before translation, each of which will be translated separately.',
+                    precision=0)
+                translation_timeout = gr.Number(value=params.get('translation_timeout', 10), label='Translation timeout (seconds)',
+                    info='Maximum time to wait for translation before retrying or failing.',
+                    precision=0)
+                message_timeout = gr.Number(value=params.get('message_timeout', 30), label='Message time budget (seconds)',
+                    info='Upper bound on the total time spent translating one message, including all parts and retries.',
+                    precision=0)
+                max_concurrent_requests = gr.Number(value=params.get('max_concurrent_requests', 4), label='Maximum concurrent requests',
+                    info='How many parts of a long message are sent to the translator at the same time.',
+                    precision=0)
+                debug = gr.Checkbox(value=params.get('debug', False), label='Log translation debug info to console')
+                warmup_on_startup = gr.Checkbox(value=params.get('warmup_on_startup', True), label='Warm up the translation service on startup',
+                    info='Loads the translation service and its supported languages in the background when the webui starts, so the first message is not slowed down.')
+            with gr.Accordion("Translator settings", open=False):
+                LibreTranslateAPI = gr.Textbox(value=params.get('LibreTranslateAPI', "http://localhost:5000/"), label='LibreTranslate API',
+                    info='Your LibreTranslate address and port.',
+                    type='text',)
+                LibreTranslateAPIkey = gr.Textbox(value=params.get('LibreTranslateAPIkey', ""), label='LibreTranslate API key',
+                    info='Your LibreTranslate API key',
+                    type='text',)
+                DeeplAPIkey = gr.Textbox(value=params.get('DeeplAPIkey', ""), label='Deepl API key',
+                    info='Your Deepl Translator API key',
+                    type='text',)
+                DeeplFreeAPI = gr.Checkbox(value=params.get('DeeplFreeAPI', True), label='Use the free Deepl API')
+                local_model = gr.Textbox(value=params.get('local_model', "Helsinki-NLP/opus-mt-{source}-{target}"), label='Local model',
+                    info='Hugging Face model name or path used by the local model engine. {source} and {target} are replaced by the language codes. Needs the transformers, sentencepiece and torch packages.',
+                    type='text',)
+                local_model_device = gr.Textbox(value=params.get('local_model_device', "cpu"), label='Local model device',
+                    info='Device the local model runs on, e.g. cpu or cuda.',
+                    type='text',)
+                local_model_batch_size = gr.Number(value=params.get('local_model_batch_size', 16), label='Local model batch size',
+                    info='Maximum number of texts the local model translates at once, including texts of concurrent messages.',
+                    precision=0)
+                local_model_workers = gr.Number(value=params.get('local_model_workers', 1), label='Local model workers',
+                    info='Threads running the local model. Lowering it takes effect after a restart.',
+                    precision=0)
+                requests_per_second = gr.Number(value=rate_limit(params.get('engine', 'google'), 'requests_per_second'), label='Requests per second',
+                    info='Client-side rate limit for the selected translation service. 0 means unlimited.')
+                chars_per_minute = gr.Number(value=rate_limit(params.get('engine', 'google'), 'chars_per_minute'), label='Characters per minute',
+                    info='Client-side character limit for the selected translation service. 0 means unlimited.',
+                    precision=0)
+                max_concurrency = gr.Number(value=rate_limit(params.get('engine', 'google'), 'max_concurrency', ENGINE_DEFAULT_CONCURRENCY), label='Maximum requests in flight',
+                    info='Upper bound on requests sent to the selected translation service at once, across all chats. Fewer are sent while it throttles or slows down.',
+                    precision=0)
+            with gr.Accordion("Metrics", open=False):
+                metrics = gr.Markdown(value=format_metrics())
+                with gr.Row():
+                    refresh_metrics = gr.Button("Refresh metrics")
+                    reset_metrics = gr.Button("Reset metrics")
+                metrics_export_path = gr.Textbox(value=params.get('metrics_export_path', ""), label='Metrics export file',
+                    info=f'If set, a metrics snapshot is written to this file every {METRICS_EXPORT_INTERVAL} seconds.',
+                    type='text',)
+                metrics_export_format = gr.Radio(value=params.get('metrics_export_format', 'json'), choices=['json', 'prometheus'], label='Metrics export format')
+            with gr.Accordion("Translation cache", open=False):
+                enable_disk_cache = gr.Checkbox(value=params.get('enable_disk_cache', False), label='Keep the cache on disk',
+                    info='Stores translations in translation_cache.sqlite3 next to settings.json so they survive restarts.')
+                cache_max_entries = gr.Number(value=params.get('cache_max_entries', 1000), label='Maximum cached translations in memory',
+                    precision=0)
+                cache_max_size_mb = gr.Number(value=params.get('cache_max_size_mb', 16), label='Maximum memory cache size (MB)',
+                    precision=0)
+                enable_translation_memory = gr.Checkbox(value=params.get('enable_translation_memory', True), label='Translation memory',
+                    info='Remembers translated lines so that regenerated or edited messages only send the lines that changed.')
+                translation_memory_max_entries = gr.Number(value=params.get('translation_memory_max_entries', 5000), label='Maximum remembered lines',
+                    precision=0)
+                fuzzy_match_threshold = gr.Slider(0, 1, step=0.01, value=params.get('fuzzy_match_threshold', 0), label='Fuzzy match threshold',
+                    info='Reuse the translation of a remembered line this similar (1 = identical). 0 disables fuzzy matching. Lowering it saves requests but may keep small edits untranslated.')
+                cache_stats = gr.Markdown(value=format_cache_stats())
+                with gr.Row():
+                    refresh_cache_stats = gr.Button("Refresh stats")
+                    clear_cache = gr.Button("Clear cache")
+
+    # Event functions to update the parameters in the backend
+    Translate_user_input.change(lambda x: params.update({"Translate_user_input": x}) or save_params(), Translate_user_input, None)
+    Translate_system_output.change(lambda x: params.update({"Translate_system_output": x}) or save_params(), Translate_system_output, None)
+    enable_input_caching.change(lambda x: params.update({"enable_input_caching": x}) or save_params(), enable_input_caching, None)
+    enable_output_caching.change(lambda x: params.update({"enable_output_caching": x}) or save_params(), enable_output_caching, None)
+    stream_output_translation.change(lambda x: params.update({"stream_output_translation": x}) or save_params(), stream_output_translation, None)
+    disable_split.change(lambda x: params.update({"disable_split": x}) or save_params(), disable_split, None)
+    disable_newline_replacement.change(lambda x: params.update({"disable_newline_replacement": x}) or save_params(), disable_newline_replacement, None)
+    preserve_formatting.change(lambda x: params.update({"preserve_formatting": x}) or save_params(), preserve_formatting, None)
+    rtl_support.change(lambda x: params.update({"rtl_support": x}) or save_params(), rtl_support, None)
+    skip_same_language.change(lambda x: params.update({"skip_same_language": x}) or save_params(), skip_same_language, None)
+
+    # Advanced settings
+    def update_special_symbol(x):
+        if not x:
+            raise gr.Error("Special symbol cannot be empty.")
+        params.update({"special_symbol": x})
+        save_params()
+    special_symbol.change(update_special_symbol, special_symbol, None)
+
+    def update_newline_symbol(x):
+        if not x:
+            raise gr.Error("Newline symbol cannot be empty.")
+        params.update({"newline_symbol": x})
+        save_params()
+    glossary.change(lambda x: params.update({"glossary": [term.strip() for term in x.splitlines() if term.strip()]}) or save_params(), glossary, None)
+    newline_symbol.change(update_newline_symbol, newline_symbol, None)
+
+    language.change(lambda x: params.update({"language string": language_codes[x]}) or save_params(), language, None)
+    engine.change(lambda x: params.update({"engine": engines[x]}) or save_params() or warmup_engine(engines[x]), engine, None)
+    engine.change(lambda x: gr.update(choices=language_choices(engines[x])), engine, language)
+    fallback_engines.change(lambda x: params.update({"fallback_engines": [engines[k] for k in x]}) or save_params(), fallback_engines, None)
+    hedge_requests.change(lambda x: params.update({"hedge_requests": x}) or save_params(), hedge_requests, None)
+    max_length.change(lambda x: params.update({"max_length": int(x)}) or save_params(), max_length, None)
+    translation_timeout.change(lambda x: params.update({"translation_timeout": int(x)}) or save_params(), translation_timeout, None)
+    message_timeout.change(lambda x: params.update({"message_timeout": int(x)}) or save_params(), message_timeout, None)
+    max_concurrent_requests.change(lambda x: params.update({"max_concurrent_requests": max(1, int(x))}) or save_params(), max_concurrent_requests, None)
+    debug.change(lambda x: params.update({"debug": x}) or save_params(), debug, None)
+    warmup_on_startup.change(lambda x: params.update({"warmup_on_startup": x}) or save_params(), warmup_on_startup, None)
+
+    # Translator settings
+    local_model.change(lambda x: params.update({"local_model": x}) or save_params(), local_model, None)
+    local_model_device.change(lambda x: params.update({"local_model_device": x}) or save_params(), local_model_device, None)
+    local_model_batch_size.change(lambda x: params.update({"local_model_batch_size": max(1, int(x))}) or save_params(), local_model_batch_size, None)
+    local_model_workers.change(lambda x: params.update({"local_model_workers": max(1, int(x))}) or save_params(), local_model_workers, None)
+    LibreTranslateAPI.change(lambda x: params.update({"LibreTranslateAPI": x}) or save_params() or engine_info.pop('libre', None), LibreTranslateAPI, None)
+    LibreTranslateAPIkey.change(lambda x: params.update({"LibreTranslateAPIkey": x}) or save_params(), LibreTranslateAPIkey, None)
+    DeeplAPIkey.change(lambda x: params.update({"DeeplAPIkey": x}) or save_params(), DeeplAPIkey, None)
+    DeeplFreeAPI.change(lambda x: params.update({"DeeplFreeAPI": x}) or save_params(), DeeplFreeAPI, None)
+    requests_per_second.change(lambda x: update_rate_limit('requests_per_second', max(0, x or 0)), requests_per_second, None)
+    chars_per_minute.change(lambda x: update_rate_limit('chars_per_minute', max(0, int(x or 0))), chars_per_minute, None)
+    max_concurrency.change(lambda x: update_rate_limit('max_concurrency', max(1, int(x or 1))), max_concurrency, None)
+    engine.change(lambda x: [rate_limit(engines[x], 'requests_per_second'), rate_limit(engines[x], 'chars_per_minute'),
+                             rate_limit(engines[x], 'max_concurrency', ENGINE_DEFAULT_CONCURRENCY)],
+                  engine, [requests_per_second, chars_per_minute, max_concurrency])
+
+    # Metrics
+    refresh_metrics.click(format_metrics, None, metrics)
+    reset_metrics.click(lambda: translation_metrics.reset() or format_metrics(), None, metrics)
+    metrics_export_path.change(lambda x: params.update({"metrics_export_path": x.strip()}) or start_metrics_exporter() or save_params(), metrics_export_path, None)
+    metrics_export_format.change(lambda x: params.update({"metrics_export_format": x}) or save_params(), metrics_export_format, None)
+
+    # Translation cache
+    enable_disk_cache.change(lambda x: params.update({"enable_disk_cache": x}) or configure_cache() or save_params(), enable_disk_cache, None)
+    cache_max_entries.change(lambda x: params.update({"cache_max_entries": int(x)}) or configure_cache() or save_params(), cache_max_entries, None)
+    cache_max_size_mb.change(lambda x: params.update({"cache_max_size_mb": int(x)}) or configure_cache() or save_params(), cache_max_size_mb, None)
+    refresh_cache_stats.click(format_cache_stats, None, cache_stats)
+    enable_translation_memory.change(lambda x: params.update({"enable_translation_memory": x}) or save_params(), enable_translation_memory, None)
+    translation_memory_max_entries.change(lambda x: params.update({"translation_memory_max_entries": int(x)}) or configure_cache() or save_params(), translation_memory_max_entries, None)
+    fuzzy_match_threshold.change(lambda x: params.update({"fuzzy_match_threshold": x}) or save_params(), fuzzy_match_threshold, None)
+    clear_cache.click(lambda: translation_cache.clear() or translation_memory.clear() or format_cache_stats(), None, cache_stats)
+
+# All formatting patterns combined into one alternation, so the text is tokenized in a single
+# left-to-right pass. At the same position earlier alternatives win (``` before `, ** before *),
+# and nested formatting is kept inside the outer span. Inline Markdown does not cross lines, and an
+# HTML element ends at its closing tag or the next opening of the same tag, so that unclosed tags
+# do not make every match attempt scan to the end of the text.
+# Formatting elements are protected: they are kept as they are and never sent to the engine.
+FORMATTING_PATTERN = re.compile("|".join([
+    r'```.*?```',                                 # Code block
+    r'`[^`\n]+`',                                 # Inline code
+    r'\*\*[^\n]*?\*\*',                           # Bold
+    r'__[^\n]*?__',                               # Underline
+    r'~~[^\n]*?~~',                               # Strikethrough
+    r'\*[^*\n]+\*',                               # Italic
+    r'<(?P<tag>b|i|u|s|code)>(?:(?!</?(?P=tag)>).)*</(?P=tag)>',  # HTML style formatting (already in the text)
+    r'\[[^\]\n]*\]\([^)\n]*\)',                    # Markdown links
+    r'<a\s+href=[\'"][^\'"]*[\'"]>(?:(?!<a\s|</a>).)*</a>',  # HTML links
+]), re.DOTALL)
+
+# Character card macros ({{char}}, {{user}}, {{random:a,b}}, ...) and the <START> separator of
+# example dialogues, which front ends substitute or parse after the text is translated
+CARD_MACRO_PATTERN = re.compile(r'\{\{[^{}\n]+\}\}|<START>')
+
+@functools.lru_cache(maxsize=8)
+def span_pattern(special_symbol, preserve_formatting):
+    """
+    Compiled pattern matching the protected spans other than glossary terms: formatting elements,
+    if they are preserved, card macros and text between two special symbols on the same line
+    """
+    alternatives = [FORMATTING_PATTERN.pattern] if preserve_formatting else []
+    alternatives.append(CARD_MACRO_PATTERN.pattern)
+    symbol = re.escape(special_symbol)
+    alternatives.append(f"{symbol}[^\\n]+?{symbol}")
+    return re.compile("|".join(alternatives), re.DOTALL)
+
+class Glossary:
+    """
+    Do-not-translate terms, found with an Aho-Corasick automaton in a single pass over the text
+
+    Terms match case-sensitively and as whole words: a term that starts or ends with a letter or
+    digit does not match inside a longer word, except in scripts written without spaces.
+    Overlapping matches are resolved leftmost-longest.
+    """
+    def __init__(self, terms):
+        self.goto = [{}]  # state -> character -> next state
+        self.fail = [0]
+        self.lengths = [()]  # state -> lengths of the terms ending in it, longest first
+        for term in terms:
+            state = 0
+            for char in term:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = self.goto[state][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.lengths.append(())
+                state = next_state
+            self.lengths[state] = (len(term),)
+
+        # Failure links in breadth-first order, so every state's fallback is complete before it is used
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.lengths[next_state] += self.lengths[self.fail[next_state]]
+
+    @staticmethod
+    def joins(a, b):
+        """Whether two adjacent characters belong to the same word"""
+        return a.isalnum() and b.isalnum() and a < '\u2e80' and b < '\u2e80'
+
+    def find(self, text, start=0, end=None):
+        """
+        Returns:
+            List of (start, end) offsets of the terms in text[start:end], in order
+        """
+        end = len(text) if end is None else end
+        goto, fail, lengths = self.goto, self.fail, self.lengths
+        longest = {}  # match start -> end of the longest match starting there
+        state = 0
+        for pos in range(start, end):
+            char = text[pos]
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length in lengths[state]:
+                match_start = pos + 1 - length
+                if match_start > 0 and self.joins(text[match_start - 1], text[match_start]):
+                    continue
+                if pos + 1 < len(text) and self.joins(text[pos], text[pos + 1]):
+                    continue
+                longest[match_start] = pos + 1  # later matches from the same start are longer
+        matches = []
+        covered = start
+        for match_start in sorted(longest):
+            if match_start >= covered:
+                matches.append((match_start, longest[match_start]))
+                covered = longest[match_start]
+        return matches
+
+@functools.lru_cache(maxsize=8)
+def compile_glossary(terms):
+    terms = [term.strip() for term in terms if term.strip()]
+    return Glossary(terms) if terms else None
+
+def protected_runs(text, settings):
+    """
+    Split text into translatable runs and protected spans in one left-to-right pass
+
+    Formatting elements (when preserve_formatting is on) and text between special symbols are
+    found by one alternation; glossary terms are looked up in the text between them.
+
+    Returns:
+        List of (text, protected) pairs that concatenate to the whole text
+    """
+    runs = []
+    glossary = settings.glossary
+
+    def add_gap(start, end):
+        if glossary is not None:
+            for term_start, term_end in glossary.find(text, start, end):
+                if term_start > start:
+                    runs.append((text[start:term_start], False))
+                runs.append((text[term_start:term_end], True))
+                start = term_end
+        if end > start:
+            runs.append((text[start:end], False))
+
+    position = 0
+    for match in settings.span_pattern.finditer(text):
+        add_gap(position, match.start())
+        runs.append((match.group(0), True))
+        position = match.end()
+    add_gap(position, len(text))
+    return runs